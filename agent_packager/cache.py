@@ -0,0 +1,195 @@
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+import requests
+
+from . import exceptions, utils
+
+
+ARCHIVE_NAME = 'package.tar.gz'
+MANIFEST_NAME = ARCHIVE_NAME + '.manifest.json'
+
+lgr = logging.getLogger()
+
+
+class FilesystemCache(object):
+    """A cache of agent packages in a local or shared (e.g. NFS) directory.
+
+    Every entry is a directory named after its key, holding the package
+    and its manifest. Entries are written to a temporary directory which
+    is then renamed into place, so readers never see partial entries, and
+    when several builders publish the same key, the first one wins.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def contains(self, key):
+        return os.path.isfile(os.path.join(self.path, key, ARCHIVE_NAME))
+
+    def fetch(self, key, destination):
+        """copies a cached package and its manifest to destination
+
+        :return: whether the key was found
+        """
+        entry = os.path.join(self.path, key)
+        if not os.path.isfile(os.path.join(entry, ARCHIVE_NAME)):
+            return False
+        _, manifest = utils.get_sidecar_paths(destination)
+        shutil.copyfile(os.path.join(entry, MANIFEST_NAME), manifest)
+        shutil.copyfile(os.path.join(entry, ARCHIVE_NAME), destination)
+        return True
+
+    def publish(self, key, archive):
+        """adds a package and its manifest to the cache
+        """
+        entry = os.path.join(self.path, key)
+        if os.path.isdir(entry):
+            lgr.debug('{0} is already cached'.format(key))
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = tempfile.mkdtemp(prefix='.{0}-'.format(key), dir=self.path)
+        try:
+            _, manifest = utils.get_sidecar_paths(archive)
+            shutil.copyfile(manifest, os.path.join(tmp, MANIFEST_NAME))
+            shutil.copyfile(archive, os.path.join(tmp, ARCHIVE_NAME))
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # a concurrent builder published this key first
+                if not os.path.isdir(entry):
+                    raise
+                lgr.debug('{0} was published concurrently'.format(key))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+class HTTPCache(object):
+    """A cache of agent packages on an HTTP server supporting GET and PUT.
+
+    The package is uploaded with `If-None-Match: *`, so that only the
+    first of several concurrent builders publishes a key; its manifest is
+    uploaded afterwards. Entries without a manifest are treated as missing,
+    and replaced by the next builder publishing their key.
+    """
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.url
+
+    def _url(self, key, name):
+        return '{0}/{1}/{2}'.format(self.url, key, name)
+
+    def _download(self, url, destination):
+        response = requests.get(url, stream=True, timeout=self.timeout)
+        if response.status_code == 404:
+            return False
+        if not response.status_code == 200:
+            raise exceptions.DownloadError(
+                '{0}: {1}'.format(url, response.status_code))
+        tmp = '{0}.{1}.part'.format(destination, uuid.uuid4().hex)
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    f.write(chunk)
+            os.rename(tmp, destination)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return True
+
+    def contains(self, key):
+        response = requests.head(self._url(key, MANIFEST_NAME),
+                                 timeout=self.timeout)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def fetch(self, key, destination):
+        """downloads a cached package and its manifest to destination
+
+        :return: whether the key was found
+        """
+        _, manifest = utils.get_sidecar_paths(destination)
+        if not self._download(self._url(key, MANIFEST_NAME), manifest):
+            return False
+        if not self._download(self._url(key, ARCHIVE_NAME), destination):
+            os.remove(manifest)
+            return False
+        return True
+
+    def _upload(self, path, url, headers=None):
+        with open(path, 'rb') as f:
+            return requests.put(url, data=f, headers=headers,
+                                timeout=self.timeout)
+
+    def publish(self, key, archive):
+        """uploads a package and its manifest to the cache
+        """
+        url = self._url(key, ARCHIVE_NAME)
+        response = self._upload(archive, url, headers={'If-None-Match': '*'})
+        if response.status_code == 412:
+            if self.contains(key):
+                lgr.debug('{0} is already cached'.format(key))
+                return
+            # its publisher failed before uploading the manifest
+            lgr.info('Replacing {0}, which has no manifest'.format(key))
+            response = self._upload(archive, url)
+        response.raise_for_status()
+        _, manifest = utils.get_sidecar_paths(archive)
+        self._upload(manifest, self._url(key, MANIFEST_NAME)) \
+            .raise_for_status()
+
+
+def get_cache(url):
+    """returns a cache backend for a url (http/https) or a path
+    """
+    if url.startswith(('http://', 'https://')):
+        return HTTPCache(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return FilesystemCache(url)
+
+
+def fetch(cache, key, destination):
+    """fetches and verifies a package from the cache
+
+    Any error is logged rather than raised, as a failing cache should
+    never fail a build.
+    :return: whether a verified package was fetched to destination
+    """
+    lgr.info('Looking up {0} in cache {1}...'.format(key, cache))
+    try:
+        if not cache.fetch(key, destination):
+            lgr.info('Package not found in cache')
+            return False
+        utils.verify_tar(destination)
+        digest, files = utils.read_manifest(destination)
+        utils.write_sidecars(destination, digest, files)
+    except Exception as e:
+        lgr.warning('Could not fetch package from cache: {0}'.format(e))
+        for path in (destination,) + utils.get_sidecar_paths(destination):
+            if os.path.isfile(path):
+                os.remove(path)
+        return False
+    lgr.info('Fetched package from cache')
+    return True
+
+
+def publish(cache, key, archive):
+    """publishes a package to the cache, logging rather than raising errors
+    """
+    lgr.info('Publishing {0} to cache {1}...'.format(key, cache))
+    try:
+        cache.publish(key, archive)
+    except Exception as e:
+        lgr.warning('Could not publish package to cache: {0}'.format(e))
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import threading
+
+
+lgr = logging.getLogger()
+
+
+class Checkpoint(object):
+    """The progress of a build, recorded so that an interrupted build can
+    be resumed (see `packager.create`).
+
+    Holds the stages completed so far and the modules installed so far,
+    along with the fingerprint of the build's config, as progress made
+    with a different config can't be resumed. The file is rewritten on
+    every change, by writing a temporary file and renaming it into place,
+    so it is never left partially written.
+    :param string path: path of the checkpoint file.
+    :param string fingerprint: the fingerprint of the build's config.
+    """
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.stages = []
+        self.installed = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """returns the checkpoint recorded in a file, or None if there is
+        none, or it was recorded with another config
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except ValueError:
+            lgr.warning('Ignoring invalid checkpoint {0}'.format(path))
+            return None
+        if not data.get('fingerprint') == fingerprint:
+            return None
+        checkpoint = cls(path, fingerprint)
+        checkpoint.stages = data.get('stages', [])
+        checkpoint.installed = data.get('installed', [])
+        return checkpoint
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '{0}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump({
+                'fingerprint': self.fingerprint,
+                'stages': self.stages,
+                'installed': self.installed,
+            }, f, indent=4, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def complete_stage(self, name):
+        with self._lock:
+            if name not in self.stages:
+                self.stages.append(name)
+                self._save()
+
+    def is_installed(self, module):
+        return module in self.installed
+
+    def install(self, module):
+        """records that a module was installed
+        """
+        with self._lock:
+            if module not in self.installed:
+                self.installed.append(module)
+                self._save()
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
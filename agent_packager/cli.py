@@ -4,7 +4,7 @@ import sys
 
 import pkg_resources
 
-from . import packager
+from . import history, packager, preflight
 
 
 lgr = logging.getLogger()
@@ -17,15 +17,178 @@ def ver_check():
 
 
 def _run(args):
+    # read the config before raising the verbosity, so that nothing is
+    # logged before create() moves the log off a package streamed to stdout
+    config = packager._import_config(args.config)
     packager.set_global_verbosity_level(args.verbose)
 
     packager.create(
-        config_file=args.config,
+        config=config,
         force=args.force,
         dryrun=args.dryrun,
         no_validate=args.no_validation,
         verbose=args.verbose,
+        validation=args.validation,
+        no_preflight=args.no_preflight,
+        no_cache=args.no_cache,
+        critical_path=args.critical_path,
+        resume=args.resume,
+        output=args.output,
+    )
+
+
+def _verify(args):
+    packager.set_global_verbosity_level(args.verbose)
+
+    packager.verify(args.archive)
+
+
+def _verify_parser():
+    parser = argparse.ArgumentParser(
+        prog='cfy-ap verify',
+        description="Verify an agent package against its manifest file"
+    )
+    parser.add_argument(
+        'archive',
+        help="Path to the agent package",
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Verbose level logging.",
+        action="store_true",
+        default=False,
+    )
+    return parser
+
+
+def _check(args):
+    packager.set_global_verbosity_level(args.verbose)
+
+    packager.check(
+        config_file=args.config,
+        verbose=args.verbose,
+        jobs=args.jobs,
+    )
+
+
+def _check_parser():
+    parser = argparse.ArgumentParser(
+        prog='cfy-ap check',
+        description="Check that all sources in the config are available"
+    )
+    parser.add_argument(
+        '-c', '--config',
+        help="Path to config yaml",
+        default="config.yaml",
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        help="Number of sources to check concurrently.",
+        type=int,
+        default=preflight.DEFAULT_JOBS,
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Verbose level logging.",
+        action="store_true",
+        default=False,
+    )
+    return parser
+
+
+def _history(args):
+    packager.set_global_verbosity_level(args.verbose)
+
+    regressions = packager.show_history(
+        config_file=args.config,
+        path=args.file,
+        last=args.last,
+        baseline=args.baseline,
+        thresholds={
+            'duration': args.max_duration_increase,
+            'archive_size': args.max_size_increase,
+            'stage': args.max_stage_increase,
+        },
+        fingerprint=args.fingerprint,
+        verbose=args.verbose,
+    )
+    if regressions:
+        sys.exit(1)
+
+
+def _history_parser():
+    parser = argparse.ArgumentParser(
+        prog='cfy-ap history',
+        description="Show the trends of recorded builds, and exit with an "
+                    "error if the most recent build regressed"
     )
+    parser.add_argument(
+        '-c', '--config',
+        help="Path to config yaml, which sets the history database. Only "
+             "the builds of this config are shown.",
+        default=None,
+    )
+    parser.add_argument(
+        '--file',
+        help="Path to the history database, instead of the one in the "
+             "config.",
+        default=None,
+    )
+    parser.add_argument(
+        '-n', '--last',
+        help="Number of most recent builds to show.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        '--baseline',
+        help="Number of preceding builds each build is compared to.",
+        type=int,
+        default=history.DEFAULT_BASELINE,
+    )
+    parser.add_argument(
+        '--max-duration-increase',
+        help="Increase of the build's duration, in percent, which is a "
+             "regression.",
+        type=float,
+        default=history.DEFAULT_THRESHOLDS['duration'],
+    )
+    parser.add_argument(
+        '--max-size-increase',
+        help="Increase of the package's size, in percent, which is a "
+             "regression.",
+        type=float,
+        default=history.DEFAULT_THRESHOLDS['archive_size'],
+    )
+    parser.add_argument(
+        '--max-stage-increase',
+        help="Increase of any stage's duration, in percent, which is a "
+             "regression.",
+        type=float,
+        default=history.DEFAULT_THRESHOLDS['stage'],
+    )
+    parser.add_argument(
+        '--fingerprint',
+        help="Only show builds of this config fingerprint, or of "
+             "fingerprints starting with this prefix.",
+        default=None,
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Verbose level logging.",
+        action="store_true",
+        default=False,
+    )
+    return parser
+
+
+# subcommands, mapped to a function building their parser and to
+# a function running them. Running without a subcommand creates a package.
+COMMANDS = {
+    'check': (_check_parser, _check),
+    'history': (_history_parser, _history),
+    'verify': (_verify_parser, _verify),
+}
 
 
 def main():
@@ -35,8 +198,15 @@ def main():
         format="%(asctime)s %(levelname)s - %(message)s"
     )
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        make_parser, run = COMMANDS[sys.argv[1]]
+        run(make_parser().parse_args(sys.argv[2:]))
+        return
+
     parser = argparse.ArgumentParser(
-        description="Script to run Cloudify's Agent Packager via command line"
+        description="Script to run Cloudify's Agent Packager via command line",
+        epilog="Other commands: {0}. Run `cfy-ap COMMAND -h` for "
+               "help on a command.".format(', '.join(sorted(COMMANDS))),
     )
 
     parser.add_argument(
@@ -51,6 +221,13 @@ def main():
         help="Path to config yaml",
         default="config.yaml",
     )
+    parser.add_argument(
+        '-o', '--output',
+        help="Path of the package to create, instead of the one in the "
+             "config. Use - to write it to stdout, or an http url to "
+             "upload it to.",
+        default=None,
+    )
     parser.add_argument(
         '-f', '--force',
         help="Forces deletion and creation of venv and tar file.",
@@ -59,7 +236,9 @@ def main():
     )
     parser.add_argument(
         '-d', '--dryrun',
-        help="Prints out modules to be installed without installing them.",
+        help="Prints out modules to be installed and estimates the "
+             "download size, package size and build time, without "
+             "installing them.",
         action="store_true",
         default=False,
     )
@@ -75,6 +254,39 @@ def main():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        '--no-preflight',
+        help="Does not check that all sources are available before "
+             "creating the venv.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        '--no-cache',
+        help="Does not use the package cache configured in the config.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        '--critical-path',
+        help="Prints the chain of build stages which determined the "
+             "build's duration.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        '--resume',
+        help="Resumes an interrupted build, skipping what it completed.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        '--validation',
+        help="How to validate the installation: check the list of "
+             "installed modules (freeze) or import all modules (imports).",
+        choices=['freeze', 'imports'],
+        default=None,
+    )
 
     args = parser.parse_args()
 
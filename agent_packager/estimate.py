@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import time
+
+
+# the share of the virtualenv's size its tar.gz file is assumed to take,
+# unless previous builds tell otherwise
+ARCHIVE_RATIO = 0.35
+# the number of most recent builds predictions are based on
+HISTORY_SIZE = 10
+
+lgr = logging.getLogger()
+
+
+def record_build(path, fingerprint, timings, venv_size, archive_size):
+    """appends a build's stage timings and sizes to a timings file
+
+    The file holds one JSON object per line, so that several builds can
+    append to it without rewriting it.
+    :param string path: path of the timings file.
+    :param string fingerprint: the fingerprint of the build's config.
+    :param dict timings: maps each stage to its start and end times,
+     see `scheduler.Scheduler.timings`.
+    :param int venv_size: the size of the virtualenv, in bytes.
+    :param int archive_size: the size of the package, in bytes.
+    """
+    entry = {
+        'time': time.time(),
+        'fingerprint': fingerprint,
+        'duration': max(end for _, end in timings.values()),
+        'stages': dict((name, end - start)
+                       for name, (start, end) in timings.items()),
+        'venv_size': venv_size,
+        'archive_size': archive_size,
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def load_builds(path):
+    """returns the builds recorded in a timings file, oldest first
+    """
+    if not os.path.isfile(path):
+        return []
+    builds = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                builds.append(json.loads(line))
+            except ValueError:
+                lgr.warning('Ignoring invalid entry {0}:{1}'.format(
+                    path, number))
+    return builds
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def predict(builds, fingerprint=None):
+    """predicts the duration and sizes of a build from previous builds
+
+    Only the most recent builds are considered, preferring those with the
+    same fingerprint, i.e. of the same config. Every figure is the median
+    of those builds.
+    :param list builds: previous builds, oldest first, see `load_builds`.
+    :param string fingerprint: the fingerprint of the build's config.
+    :return: dict of the number of builds the prediction is based on,
+     whether they match the fingerprint, and the predicted `duration`,
+     `stages` durations, `venv_size` and `archive_ratio`, which are None
+     if unknown
+    """
+    matching = [build for build in builds
+                if fingerprint and build.get('fingerprint') == fingerprint]
+    recent = (matching or builds)[-HISTORY_SIZE:]
+    stages = {}
+    for build in recent:
+        for name, duration in build.get('stages', {}).items():
+            stages.setdefault(name, []).append(duration)
+    return {
+        'builds': len(recent),
+        'matching': bool(matching),
+        'duration': median(build['duration'] for build in recent
+                           if build.get('duration') is not None),
+        'stages': dict((name, median(durations))
+                       for name, durations in stages.items()),
+        'venv_size': median(build['venv_size'] for build in recent
+                            if build.get('venv_size')) if matching else None,
+        'archive_ratio': median(
+            float(build['archive_size']) / build['venv_size']
+            for build in recent
+            if build.get('venv_size') and build.get('archive_size')),
+    }
@@ -19,6 +19,10 @@ class PipUninstallError(AgentPackagerError):
     _prefix = 'Could not uninstall: '
 
 
+class ImportCheckError(AgentPackagerError):
+    _prefix = 'Import check failed: '
+
+
 class DownloadError(AgentPackagerError):
     _prefix = 'Could not download '
 
@@ -27,5 +31,21 @@ class TarCreateError(AgentPackagerError):
     _prefix = 'Failed to create tar file: '
 
 
+class UploadError(AgentPackagerError):
+    _prefix = 'Could not upload '
+
+
+class PreflightError(AgentPackagerError):
+    _prefix = 'Preflight check failed: '
+
+
+class ArchiveVerificationError(AgentPackagerError):
+    _prefix = 'Archive verification failed: '
+
+
+class StripError(AgentPackagerError):
+    _prefix = 'Could not strip debug symbols: '
+
+
 class ConfigFileError(AgentPackagerError):
     _prefix = 'Config file error: '
@@ -0,0 +1,165 @@
+"""Downloads and extracts a chunked agent package concurrently.
+
+A chunked package (see the `chunks` option of the `output` config
+section) consists of an index file and several independent tar.gz files.
+This module only uses the standard library, so it can be copied to and
+run on agent hosts as is:
+
+    python extractor.py http://server/Ubuntu-trusty-agent.index.json -d /opt
+
+Every chunk is streamed straight from its source into the destination
+directory, and its sha256 is checked against the index. The first chunk,
+which holds all directories, is extracted before the others.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tarfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urljoin
+except ImportError:
+    # py2
+    from urllib2 import urlopen
+    from urlparse import urljoin
+
+
+DEFAULT_JOBS = 8
+
+lgr = logging.getLogger()
+
+
+class _HashingReader(object):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+
+def _open(source):
+    if _is_url(source):
+        return urlopen(source)
+    return open(source, 'rb')
+
+
+def load_index(index):
+    """returns the contents of a local or remote index file
+    """
+    f = _open(index)
+    try:
+        return json.loads(f.read().decode('utf-8'))
+    finally:
+        f.close()
+
+
+def extract_chunk(source, destination, sha256):
+    """extracts a single chunk while streaming it from its source
+
+    :return: an error message, or None if the chunk was extracted and
+     its checksum matches
+    """
+    lgr.debug('Extracting {0}'.format(source))
+    f = _open(source)
+    try:
+        reader = _HashingReader(f)
+        with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(destination, filter='tar')
+            else:
+                tar.extractall(destination)
+        while reader.read(65536):
+            pass
+    except Exception as e:
+        return '{0}: {1}'.format(source, e)
+    finally:
+        f.close()
+    if reader.hexdigest() != sha256:
+        return '{0}: checksum mismatch'.format(source)
+    return None
+
+
+def extract(index, destination='.', jobs=DEFAULT_JOBS):
+    """downloads and extracts all chunks listed in an index concurrently
+
+    :param string index: path or url of the index file.
+    :param string destination: directory to extract to.
+    :param int jobs: the number of chunks to extract concurrently.
+    """
+    chunks = load_index(index)['chunks']
+    if _is_url(index):
+        sources = [urljoin(index, chunk['name']) for chunk in chunks]
+    else:
+        sources = [os.path.join(os.path.dirname(index), chunk['name'])
+                   for chunk in chunks]
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+
+    # the first chunk holds all directories, which must exist before the
+    # other chunks are extracted concurrently, as tarfile creating a
+    # missing parent directory in several threads at once fails
+    errors = [extract_chunk(sources[0], destination, chunks[0]['sha256'])]
+    if len(chunks) > 1:
+        pool = ThreadPool(min(jobs, len(chunks) - 1))
+        try:
+            errors.extend(pool.map(
+                lambda i: extract_chunk(
+                    sources[i], destination, chunks[i]['sha256']),
+                range(1, len(chunks))))
+        finally:
+            pool.close()
+            pool.join()
+    errors = [error for error in errors if error]
+    if errors:
+        raise RuntimeError('Failed extracting {0}:\n{1}'.format(
+            index, '\n'.join(errors)))
+    lgr.info('Extracted {0} chunks to {1}'.format(len(chunks), destination))
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s - %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Download and extract a chunked agent package"
+    )
+    parser.add_argument(
+        'index',
+        help="Path or url of the package's index file",
+    )
+    parser.add_argument(
+        '-d', '--destination',
+        help="Directory to extract to.",
+        default='.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        help="Number of chunks to download and extract concurrently.",
+        type=int,
+        default=DEFAULT_JOBS,
+    )
+    args = parser.parse_args()
+
+    extract(args.index, args.destination, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
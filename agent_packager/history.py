@@ -0,0 +1,238 @@
+import contextlib
+import logging
+import sqlite3
+import time
+
+from .estimate import median
+
+
+# the number of previous builds each build is compared to
+DEFAULT_BASELINE = 5
+# builds with fewer previous builds than this aren't checked
+MIN_BASELINE = 3
+# the default increases, in percent of the baseline, which are regressions
+DEFAULT_THRESHOLDS = {
+    'duration': 50,
+    'archive_size': 10,
+    'stage': 100,
+}
+# durations increasing by less than this many seconds are never regressions
+MIN_DURATION_INCREASE = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    fingerprint TEXT,
+    duration REAL,
+    venv_size INTEGER,
+    archive_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    name TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packages (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    name TEXT NOT NULL,
+    version TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS phases_build ON phases(build_id);
+CREATE INDEX IF NOT EXISTS packages_build ON packages(build_id);
+"""
+
+lgr = logging.getLogger()
+
+
+def _connect(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def record_build(path, fingerprint, timings, venv_size, archive_size,
+                 installed=()):
+    """records a build in a history database, creating it if needed
+
+    :param string path: path of the SQLite database.
+    :param string fingerprint: the fingerprint of the build's config.
+    :param dict timings: maps each stage to its start and end times,
+     see `scheduler.Scheduler.timings`.
+    :param int venv_size: the size of the virtualenv, in bytes.
+    :param int archive_size: the size of the package, in bytes.
+    :param list installed: the installed distributions, as dicts of their
+     name, version and size, see `utils.get_distributions`.
+    :return: the id of the recorded build
+    """
+    with contextlib.closing(_connect(path)) as connection:
+        with connection:
+            cursor = connection.execute(
+                'INSERT INTO builds (time, fingerprint, duration, venv_size, '
+                'archive_size) VALUES (?, ?, ?, ?, ?)',
+                (time.time(), fingerprint,
+                 max(end for _, end in timings.values()) if timings else None,
+                 venv_size, archive_size))
+            build_id = cursor.lastrowid
+            connection.executemany(
+                'INSERT INTO phases (build_id, name, start, end) '
+                'VALUES (?, ?, ?, ?)',
+                [(build_id, name, start, end)
+                 for name, (start, end) in sorted(timings.items())])
+            connection.executemany(
+                'INSERT INTO packages (build_id, name, version, size) '
+                'VALUES (?, ?, ?, ?)',
+                [(build_id, dist['name'], dist.get('version'),
+                  dist.get('size')) for dist in installed])
+    return build_id
+
+
+def load_builds(path, fingerprint=None, limit=None, packages=False):
+    """returns the builds recorded in a history database, oldest first
+
+    The builds are dicts like those of `estimate.load_builds`, so they can
+    be used for predictions as well, along with their `id`.
+    :param string fingerprint: only return builds of this fingerprint, or
+     of fingerprints starting with it.
+    :param int limit: only return this many of the most recent builds.
+    :param bool packages: whether to also return the distributions every
+     build installed, as `installed`, a dict mapping each name to its
+     version and size.
+    """
+    query = 'SELECT id, time, fingerprint, duration, venv_size, ' \
+        'archive_size FROM builds'
+    params = []
+    if fingerprint:
+        query += ' WHERE fingerprint LIKE ?'
+        params.append(fingerprint + '%')
+    query += ' ORDER BY id DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    with contextlib.closing(_connect(path)) as connection:
+        builds = []
+        for row in reversed(connection.execute(query, params).fetchall()):
+            build_id, build_time, build_fingerprint, duration, venv_size, \
+                archive_size = row
+            build = {
+                'id': build_id,
+                'time': build_time,
+                'fingerprint': build_fingerprint,
+                'duration': duration,
+                'venv_size': venv_size,
+                'archive_size': archive_size,
+                'stages': dict(
+                    (name, end - start) for name, start, end in
+                    connection.execute(
+                        'SELECT name, start, end FROM phases '
+                        'WHERE build_id = ?', (build_id,))),
+            }
+            if packages:
+                build['installed'] = dict(
+                    (name, {'version': version, 'size': size})
+                    for name, version, size in connection.execute(
+                        'SELECT name, version, size FROM packages '
+                        'WHERE build_id = ?', (build_id,)))
+            builds.append(build)
+    return builds
+
+
+def _increase(value, baseline):
+    """returns how much a value exceeds its baseline, in percent, or None
+    """
+    if value is None or not baseline:
+        return None
+    return (value - baseline) * 100.0 / baseline
+
+
+def compare(build, previous, thresholds=None):
+    """compares a build to the median of previous builds
+
+    :param dict build: the build to check, see `load_builds`.
+    :param list previous: the builds to compare it to.
+    :param dict thresholds: the increases, in percent, of the `duration`,
+     `archive_size` and the duration of any `stage`, which are regressions.
+     Missing ones default to `DEFAULT_THRESHOLDS`.
+    :return: dict of the `increases` of the duration and package size, in
+     percent (None if unknown), and the `regressions` found, as messages
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    result = {'increases': {}, 'regressions': []}
+    for key in ('duration', 'archive_size'):
+        baseline = median(b[key] for b in previous if b.get(key))
+        increase = _increase(build.get(key), baseline)
+        result['increases'][key] = increase
+        if len(previous) < MIN_BASELINE or increase is None or \
+                increase <= thresholds[key]:
+            continue
+        if key == 'duration' and \
+                build[key] - baseline < MIN_DURATION_INCREASE:
+            continue
+        result['regressions'].append(
+            '{0} increased by {1:.0f}% ({2} -> {3})'.format(
+                key.replace('_', ' '), increase,
+                _format(key, baseline), _format(key, build[key])))
+    if len(previous) < MIN_BASELINE:
+        return result
+    for name, duration in sorted(build.get('stages', {}).items()):
+        baseline = median(b['stages'][name] for b in previous
+                          if name in b.get('stages', {}))
+        increase = _increase(duration, baseline)
+        if increase is not None and increase > thresholds['stage'] and \
+                duration - baseline >= MIN_DURATION_INCREASE:
+            result['regressions'].append(
+                'stage {0} increased by {1:.0f}% ({2} -> {3})'.format(
+                    name, increase, _format('duration', baseline),
+                    _format('duration', duration)))
+    return result
+
+
+def _format(key, value):
+    if key == 'duration':
+        return '{0:.1f}s'.format(value)
+    return '{0:.1f}MB'.format(value / 1024.0 ** 2)
+
+
+def package_changes(build, previous):
+    """returns the distributions a build installed which a previous build
+    didn't, or which grew, as messages, largest first
+    """
+    installed = build.get('installed') or {}
+    before = previous.get('installed') or {}
+    changes = []
+    for name, dist in installed.items():
+        size = dist['size'] or 0
+        if name not in before:
+            changes.append((size, '{0} {1} was added ({2})'.format(
+                name, dist['version'], _format('size', size))))
+        elif size > (before[name]['size'] or 0):
+            changes.append((
+                size - (before[name]['size'] or 0),
+                '{0} grew by {1} ({2} -> {3})'.format(
+                    name, _format('size', size - (before[name]['size'] or 0)),
+                    before[name]['version'], dist['version'])))
+    return [message for _, message in sorted(changes, reverse=True)]
+
+
+def previous_builds(builds, index):
+    """returns the builds preceding a build which have its fingerprint,
+    oldest first, as builds of other configs aren't comparable
+    """
+    return [build for build in builds[:index]
+            if build['fingerprint'] == builds[index]['fingerprint']]
+
+
+def check(builds, baseline=DEFAULT_BASELINE, thresholds=None):
+    """compares every build to a rolling baseline: the median of the
+    builds of the same fingerprint preceding it
+
+    :param list builds: the builds, oldest first, see `load_builds`.
+    :param int baseline: the number of preceding builds to compare to.
+    :param dict thresholds: see `compare`.
+    :return: a list of the result of `compare` for every build
+    """
+    return [compare(build, previous_builds(builds, i)[-baseline:],
+                    thresholds)
+            for i, build in enumerate(builds)]
@@ -0,0 +1,455 @@
+import base64
+import csv
+import glob
+import hashlib
+import io
+import logging
+import os
+import re
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+import pkg_resources
+
+from . import exceptions, preflight, utils
+
+
+DEFAULT_JOBS = 8
+INSTALLER_NAME = 'cfy-ap'
+
+SCRIPT_TEMPLATE = """#!{python}
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+    sys.exit({function}())
+"""
+
+lgr = logging.getLogger()
+
+
+class PipInstaller(object):
+    """Installs modules by running the virtualenv's pip.
+
+    :param string venv: path of the virtualenv to install in.
+    """
+    name = 'pip'
+
+    def __init__(self, venv):
+        self.venv = venv
+
+    def install(self, module):
+        """installs a module, given as a requirement, a url or a path
+        """
+        utils.install_module(module, self.venv)
+
+    def install_modules(self, modules):
+        for module in modules:
+            self.install(module)
+
+    def install_requirements_file(self, path):
+        utils.install_requirements_file(path, self.venv)
+
+
+def canonical_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_wheel_name(path):
+    """returns the project name, version and tags of a wheel file
+
+    :return: a tuple of the canonical name, the version and the set of
+     tags (e.g. `py2.py3-none-any` stands for two tags)
+    """
+    parts = os.path.basename(path)[:-len('.whl')].split('-')
+    if len(parts) not in (5, 6):
+        raise ValueError('Invalid wheel name: {0}'.format(path))
+    python, abi, platform = parts[-3:]
+    tags = set('{0}-{1}-{2}'.format(p, a, pl) for p in python.split('.')
+               for a in abi.split('.') for pl in platform.split('.'))
+    return canonical_name(parts[0]), parts[1], tags
+
+
+def find_wheel(wheelhouse, requirement, tags=None):
+    """returns the newest wheel in a wheelhouse which satisfies a
+    requirement and, if tags are given, supports one of them, or None
+    """
+    candidates = []
+    for path in glob.glob(os.path.join(wheelhouse, '*.whl')):
+        try:
+            name, version, wheel_tags = parse_wheel_name(path)
+        except ValueError:
+            continue
+        if name == canonical_name(requirement.project_name) and \
+                (tags is None or wheel_tags & tags) and \
+                version in requirement:
+            candidates.append((pkg_resources.parse_version(version), path))
+    return max(candidates)[1] if candidates else None
+
+
+def find_cached(wheelhouse, source):
+    """returns the wheel in a wheelhouse which a source (a requirement, or
+    the url or path of a wheel) would be installed from, or None
+
+    The tags of the wheel aren't checked, so that this can be used before
+    the virtualenv exists.
+    """
+    if not wheelhouse:
+        return None
+    name = source.split('#')[0].split('?')[0].rstrip('/').split('/')[-1]
+    if name.endswith('.whl'):
+        path = os.path.join(wheelhouse, name)
+        return path if os.path.isfile(path) else None
+    if not preflight.classify(source) == 'requirement':
+        return None
+    try:
+        requirement = pkg_resources.Requirement.parse(source)
+    except ValueError:
+        return None
+    return find_wheel(wheelhouse, requirement)
+
+
+def _record_hash(data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    return 'sha256=' + digest.rstrip(b'=').decode('ascii')
+
+
+def _get_metadata(wheel_zip, dist_info, name):
+    try:
+        return wheel_zip.read('{0}/{1}'.format(dist_info, name)).decode(
+            'utf-8')
+    except KeyError:
+        return ''
+
+
+def _find_dist_info(wheel_zip, path):
+    dist_infos = set(name.split('/')[0] for name in wheel_zip.namelist()
+                     if name.split('/')[0].endswith('.dist-info'))
+    if len(dist_infos) != 1:
+        raise ValueError('{0} should contain a single .dist-info '
+                         'directory'.format(path))
+    return dist_infos.pop()
+
+
+def get_requirements(path, extras, markers):
+    """returns the requirements of a wheel, given the extras it is
+    installed with and the environment markers of the interpreter
+    """
+    with zipfile.ZipFile(path) as wheel_zip:
+        metadata = _get_metadata(
+            wheel_zip, _find_dist_info(wheel_zip, path), 'METADATA')
+    requirements = []
+    for line in metadata.splitlines():
+        if not line.strip():
+            # the headers end here
+            break
+        if not line.startswith('Requires-Dist:'):
+            continue
+        requirement = line.split(':', 1)[1].strip()
+        marker = pkg_resources.Requirement.parse(requirement).marker
+        if marker is None or any(
+                marker.evaluate(dict(markers, extra=extra))
+                for extra in [''] + list(extras)):
+            requirements.append(requirement.split(';', 1)[0].strip())
+    return requirements
+
+
+def _write_file(source, target, mode=None):
+    if not os.path.isdir(os.path.dirname(target)):
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            # created concurrently for another wheel
+            if not os.path.isdir(os.path.dirname(target)):
+                raise
+    with open(target, 'wb') as f:
+        data = source.read()
+        f.write(data)
+    if mode:
+        os.chmod(target, mode)
+    return data
+
+
+def install_wheel(path, environment, installer=INSTALLER_NAME):
+    """installs a wheel by unpacking it, as pip would, without checking
+    its requirements
+
+    The scripts of the wheel's entry points are generated, and the
+    `INSTALLER` and `RECORD` files are added to its metadata, so that the
+    installed distribution can be managed by pip.
+    :param string path: path of the wheel file.
+    :param dict environment: the virtualenv's installation paths and
+     interpreter, see `utils.get_venv_environment`.
+    :return: the paths of the installed python files
+    """
+    paths = dict(environment['paths'])
+    python = environment['executable']
+    with zipfile.ZipFile(path) as wheel_zip:
+        dist_info = _find_dist_info(wheel_zip, path)
+        data_dir = dist_info[:-len('.dist-info')] + '.data'
+        # where pip installs headers within a virtualenv
+        paths['headers'] = os.path.join(
+            paths['data'], 'include', 'site',
+            'python' + environment['markers']['python_version'],
+            dist_info.split('-')[0])
+        wheel = _get_metadata(wheel_zip, dist_info, 'WHEEL')
+        purelib = re.search(r'^Root-Is-Purelib:\s*true\s*$', wheel,
+                            re.IGNORECASE | re.MULTILINE)
+        root = paths['purelib' if purelib else 'platlib']
+        entry_points = _get_metadata(wheel_zip, dist_info,
+                                     'entry_points.txt')
+
+        records = []
+        for info in wheel_zip.infolist():
+            name = info.filename
+            if name.endswith('/') or name == '{0}/RECORD'.format(dist_info):
+                continue
+            parts = name.split('/')
+            mode = (info.external_attr >> 16) & 0o777
+            mode = 0o755 if mode & 0o111 else None
+            if parts[0] == data_dir:
+                if parts[1] not in paths:
+                    raise ValueError('Unknown {0} directory in {1}'.format(
+                        parts[1], path))
+                target = os.path.join(paths[parts[1]], *parts[2:])
+            else:
+                target = os.path.join(root, *parts)
+            with wheel_zip.open(info) as source:
+                if parts[0] == data_dir and parts[1] == 'scripts':
+                    first, _, rest = source.read().partition(b'\n')
+                    if re.match(br'^#!pythonw?\s*$', first):
+                        # point scripts at the virtualenv's interpreter
+                        first = b'#!' + python.encode('utf-8')
+                    data = _write_file(io.BytesIO(first + b'\n' + rest),
+                                       target, 0o755)
+                else:
+                    data = _write_file(source, target, mode)
+            records.append((target, _record_hash(data), len(data)))
+
+    for section in ('console_scripts', 'gui_scripts'):
+        for script, entry_point in _parse_entry_points(
+                entry_points, section):
+            module, _, attrs = entry_point.partition(':')
+            name = attrs.split('.')[0]
+            content = SCRIPT_TEMPLATE.format(
+                python=python, module=module.strip(), name=name.strip(),
+                function=attrs.strip()).encode('utf-8')
+            target = os.path.join(paths['scripts'], script)
+            _write_file(io.BytesIO(content), target, 0o755)
+            records.append((target, _record_hash(content), len(content)))
+
+    target = os.path.join(root, dist_info, 'INSTALLER')
+    content = '{0}\n'.format(installer).encode('utf-8')
+    _write_file(io.BytesIO(content), target)
+    records.append((target, _record_hash(content), len(content)))
+
+    record = os.path.join(root, dist_info, 'RECORD')
+    rows = [(os.path.relpath(target, root), digest, size)
+            for target, digest, size in records]
+    rows.append((os.path.relpath(record, root), '', ''))
+    with open(record, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for row in rows:
+            writer.writerow(row)
+    return [target for target, _, _ in records if target.endswith('.py')]
+
+
+def _parse_entry_points(content, section):
+    entry_points = []
+    current = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', ';')):
+            continue
+        if line.startswith('['):
+            current = line.strip('[]').strip()
+        elif current == section and '=' in line:
+            name, _, value = line.partition('=')
+            # drop extras, e.g. `module:function [extra]`
+            entry_points.append((name.strip(), value.split('[')[0].strip()))
+    return entry_points
+
+
+class WheelInstaller(PipInstaller):
+    """Installs modules from wheels by unpacking them, without running pip.
+
+    A module is installed this way if it's a wheel file, or a requirement
+    which a compatible wheel in the wheelhouse satisfies. The requirements
+    of every such wheel are resolved against the wheelhouse as well, and
+    all wheels are then unpacked concurrently. Requirements which are
+    already installed are skipped. Wheels of requirements which the
+    wheelhouse lacks are built (or downloaded) into it using a single
+    `pip wheel` call, so that later builds only unpack wheels. Anything
+    else (e.g. urls of source distributions, or requirements conflicting
+    with installed modules) is installed using pip, which also installs
+    its requirements.
+    :param string venv: path of the virtualenv to install in.
+    :param string wheelhouse: a directory of wheel files.
+    :param int jobs: the number of wheels to unpack concurrently.
+    """
+    name = 'wheel'
+
+    def __init__(self, venv, wheelhouse=None, jobs=DEFAULT_JOBS):
+        super(WheelInstaller, self).__init__(venv)
+        self.wheelhouse = wheelhouse
+        self.jobs = jobs
+        self._environment = None
+
+    @property
+    def environment(self):
+        if self._environment is None:
+            self._environment = utils.get_venv_environment(self.venv)
+            if not self._environment['tags']:
+                lgr.warning('The virtualenv\'s pip is too old to tell which '
+                            'wheels it supports, installing using pip')
+        return self._environment
+
+    def resolve(self, modules):
+        """returns the wheels to unpack to install modules, and the
+        modules to install using pip
+
+        Requirements whose environment markers don't match the
+        virtualenv's interpreter are left out, as pip would.
+        :param list modules: requirements, urls or paths to install.
+        :return: a tuple of a dict mapping the canonical name of each
+         project to install to its wheel, a list of requirements no wheel
+         was found for, and a list of other modules to install using pip
+        """
+        environment = self.environment
+        if not environment['tags']:
+            return {}, [], list(modules)
+        tags = set(environment['tags'])
+        installed = dict(
+            (canonical_name(dist['name']), dist['version'])
+            for dist in utils.get_distributions(self.venv))
+        wheels = {}
+        missing = []
+        fallback = []
+        pending = [(module, ()) for module in modules]
+        while pending:
+            module, extras = pending.pop(0)
+            requirement = None
+            if module.endswith('.whl') and os.path.isfile(module):
+                wheel = module
+                name, version, wheel_tags = parse_wheel_name(wheel)
+                if not wheel_tags & tags:
+                    fallback.append(module)
+                    continue
+            else:
+                try:
+                    requirement = pkg_resources.Requirement.parse(module)
+                except ValueError:
+                    # urls, paths of source distributions, etc.
+                    fallback.append(module)
+                    continue
+                if requirement.marker is not None and \
+                        not requirement.marker.evaluate(
+                            dict(environment['markers'], extra='')):
+                    lgr.debug('Skipping {0}, which this environment '
+                              'doesn\'t require'.format(module))
+                    continue
+                if getattr(requirement, 'url', None):
+                    # direct references are installed from their url
+                    fallback.append(module)
+                    continue
+                name = canonical_name(requirement.project_name)
+                extras = requirement.extras
+                wheel = None
+            if name in wheels:
+                continue
+            if name in installed:
+                if (requirement is not None and
+                        installed[name] in requirement) or \
+                        (requirement is None and installed[name] == version):
+                    continue
+                # let pip replace the installed version
+                fallback.append(module)
+                continue
+            if requirement is not None:
+                wheel = self.wheelhouse and find_wheel(
+                    self.wheelhouse, requirement, tags)
+                if not wheel:
+                    missing.append(module)
+                    continue
+            wheels[name] = wheel
+            pending.extend(
+                (dependency, ()) for dependency in get_requirements(
+                    wheel, extras, environment['markers']))
+        return wheels, missing, fallback
+
+    def install_modules(self, modules, requirements_file=None):
+        """installs modules from wheels, using pip for those without one
+
+        :param list modules: the modules to install.
+        :param string requirements_file: the requirements file the modules
+         were read from, if any. When some can't be installed from wheels,
+         pip installs the whole file, which the unpacked wheels satisfy.
+        """
+        wheels, missing, fallback = self.resolve(modules)
+        if missing and self.wheelhouse:
+            lgr.info('Adding wheels to {0}: {1}'.format(
+                self.wheelhouse, ', '.join(missing)))
+            if utils.build_wheels(missing, self.wheelhouse, self.venv):
+                wheels, missing, fallback = self.resolve(modules)
+            else:
+                lgr.warning('Could not build wheels, installing using pip')
+        fallback = missing + fallback
+        if wheels:
+            lgr.info('Unpacking {0} wheels: {1}'.format(
+                len(wheels), ', '.join(
+                    os.path.basename(wheel) for wheel in wheels.values())))
+            pool = ThreadPool(min(self.jobs, len(wheels)))
+            try:
+                installed = pool.map(
+                    lambda wheel: install_wheel(wheel, self.environment),
+                    sorted(wheels.values()))
+            finally:
+                pool.close()
+                pool.join()
+            utils.compile_files(
+                [path for paths in installed for path in paths], self.venv)
+        if not fallback:
+            return
+        lgr.info('Installing {0} using pip'.format(', '.join(fallback)))
+        if requirements_file:
+            utils.install_requirements_file(requirements_file, self.venv)
+        else:
+            utils.install_modules(fallback, self.venv)
+
+    def install(self, module):
+        self.install_modules([module])
+
+    def install_requirements_file(self, path):
+        """installs the requirements listed in a requirements file
+
+        Files using any option (e.g. `-r` or `-e`) are installed using pip.
+        """
+        session = preflight.make_session(1)
+        try:
+            content = preflight.read_requirements_file(session, path)
+        finally:
+            session.close()
+        requirements = []
+        for line in content.splitlines():
+            line = line.split(' #', 1)[0].strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('-') or ' --' in line:
+                utils.install_requirements_file(path, self.venv)
+                return
+            requirements.append(line)
+        self.install_modules(requirements, path)
+
+
+def get_installer(name, venv, wheelhouse=None):
+    """returns an installer backend by its name, `pip` or `wheel`
+    """
+    if name == PipInstaller.name:
+        return PipInstaller(venv)
+    if name == WheelInstaller.name:
+        return WheelInstaller(venv, wheelhouse)
+    raise exceptions.ConfigFileError('Unknown installer: {0}'.format(name))
@@ -1,11 +1,25 @@
 
+import fnmatch
+import glob
+import hashlib
 import logging
 import json
+import multiprocessing
 import platform
+import re
 import shutil
 import os
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
-from . import exceptions, utils
+import pkg_resources
+
+from . import (cache, estimate, exceptions, history, installers, preflight,
+               scheduler, utils)
+from .checkpoint import Checkpoint
+from .scheduler import Scheduler, Stage
 
 try:
     from configparser import (
@@ -32,9 +46,39 @@ else:
 DEFAULT_CONFIG_FILE = 'config.yaml'
 DEFAULT_OUTPUT_TAR_PATH = '{0}-{1}-agent.tar.gz'
 DEFAULT_VENV_PATH = 'cloudify/env'
+ZIPPED_SITE_PACKAGES = 'site-packages.zip'
+# the name stored in the header of packages written to stdout
+STREAMED_ARCHIVE_NAME = 'agent.tar.gz'
+DEFAULT_MEMORY_WORKSPACE = '/dev/shm'
+CHECKPOINT_FILE = os.path.join(
+    os.path.dirname(DEFAULT_VENV_PATH), '.checkpoint.json')
+
+# rough figures used to estimate the size of the virtualenv, when deciding
+# whether to build it in memory
+BASE_VENV_SIZE = 50 * 1024 ** 2
+UNKNOWN_SOURCE_SIZE = 5 * 1024 ** 2
+SOURCE_EXPANSION = 4
+MEMORY_MARGIN = 1.5
 
 DEFAULT_CLOUDIFY_AGENT_URL = 'https://github.com/cloudify-cosmo/cloudify-agent/archive/{0}.tar.gz'  # NOQA
 
+# sources referring to a branch rather than a release, whose contents
+# change while their url stays the same
+MOVING_SOURCE = re.compile(
+    r'[/@](master|main|develop|trunk|HEAD)(\.tar\.gz|\.tgz|\.zip)?$')
+
+# config options which don't affect the contents of the package, and so
+# are not part of its fingerprint. None stands for a whole section.
+FINGERPRINT_IGNORED_OPTIONS = {
+    'system': None,
+    'build': None,
+    'cache': None,
+    # the backend installing the modules doesn't change what is installed
+    'install': ('installer', 'wheelhouse'),
+    'validate': None,
+    'output': ('tar', 'keep_virtualenv', 'version', 'milestone', 'build'),
+}
+
 lgr = logging.getLogger()
 verbose_output = False
 
@@ -52,6 +96,15 @@ def set_global_verbosity_level(is_verbose_output=False):
         lgr.setLevel(logging.INFO)
 
 
+def _log_to_stderr():
+    """moves the log handlers writing to stdout to stderr, so that the log
+    doesn't mix with a package streamed to stdout
+    """
+    for handler in lgr.handlers:
+        if getattr(handler, 'stream', None) is sys.stdout:
+            handler.stream = sys.stderr
+
+
 def get_option(config_get, *args, **kwargs):
     """Get an option from a configparser, or None if it doesn't exist.
 
@@ -114,7 +167,34 @@ def _make_venv(venv, python, force):
     utils.copy_distutils_to_virtualenv(venv)
 
 
-def _handle_output_file(destination_tar, force):
+def _is_stream(destination_tar):
+    """returns whether the package is streamed to stdout (`-`) or to an
+    http url, rather than written to a file
+    """
+    return destination_tar == '-' or \
+        destination_tar.startswith(('http://', 'https://'))
+
+
+def _get_outputs(destination_tar, chunks=None):
+    """returns the paths of all files making up a package
+
+    :param string destination_tar: destination tar path
+    :param int chunks: number of chunks, if the output is chunked.
+    """
+    if chunks:
+        index, _ = utils.get_chunk_paths(destination_tar, chunks)
+        return [index] + glob.glob(
+            index[:-len('.index.json')] + '.part*.tar.gz')
+    return [destination_tar] + list(utils.get_sidecar_paths(destination_tar))
+
+
+def _remove_outputs(destination_tar, chunks=None):
+    for path in _get_outputs(destination_tar, chunks):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _handle_output_file(destination_tar, force, chunks=None):
     """Handles the output tar.
 
     removes the output file if required, else, notifies
@@ -123,13 +203,394 @@ def _handle_output_file(destination_tar, force):
     :param string destination_tar: destination tar path
     :param bool force: whether to force creation or not if
      it already exists.
+    :param int chunks: number of chunks, if the output is chunked, in which
+     case the index file and chunks are handled instead of the tar.
     """
-    if os.path.isfile(destination_tar) and force:
+    output = _get_outputs(destination_tar, chunks)[0]
+    if os.path.isfile(output) and force:
         lgr.info('Removing previous agent package...')
-        os.remove(destination_tar)
-    if os.path.exists(destination_tar):
+        _remove_outputs(destination_tar, chunks)
+    if os.path.exists(output):
         raise exceptions.TarCreateError(
-            '{0} already exists'.format(destination_tar))
+            '{0} already exists'.format(output))
+
+
+def _read_requirements(modules):
+    """returns the contents of the requirements file and of the files it
+    includes, see `preflight.read_requirements_files`, or None if they
+    can't be read
+    """
+    source = modules.get('requirements_file')
+    if not source:
+        return {}
+    session = preflight.make_session(1)
+    try:
+        return preflight.read_requirements_files(session, source)
+    except Exception as e:
+        lgr.warning('Could not read requirements file {0}: {1}'.format(
+            source, e))
+        return None
+    finally:
+        session.close()
+
+
+def _parse_pinned(source):
+    """returns the name of a requirement, and whether it allows a single
+    version (e.g. `six==1.16.0`) or points at a url
+
+    :return: a tuple of the canonical name (None if the source isn't a
+     requirement) and whether it is pinned
+    """
+    try:
+        requirement = pkg_resources.Requirement.parse(source)
+    except ValueError:
+        return None, False
+    pinned = bool(getattr(requirement, 'url', None)) or (
+        len(requirement.specs) == 1 and
+        requirement.specs[0][0] in ('==', '===') and
+        not requirement.specs[0][1].endswith('*'))
+    return installers.canonical_name(requirement.project_name), pinned
+
+
+def _moving_sources(modules, requirements):
+    """returns the sources which refer to a branch rather than a release
+    (e.g. `master.tar.gz` urls), or to any version of a project rather
+    than a single one (e.g. `six` or `requests>=2.9.1`), and so may change
+    while the fingerprint of the package stays the same
+
+    :param dict modules: the merged modules.
+    :param dict requirements: the contents of the requirements files, see
+     `_read_requirements`.
+    """
+    sources = list(modules['additional_modules']) + \
+        list(modules['additional_plugins'].values()) + [modules['agent']]
+    for path, content in (requirements or {}).items():
+        sources.extend(check.source for check in
+                       preflight.parse_requirements(content, path))
+    parsed = dict(
+        (source, _parse_pinned(source)) for source in sources
+        if preflight.classify(source) == 'requirement')
+    # a requirement may be pinned by another line, e.g. of a constraints file
+    pinned = set(name for name, is_pinned in parsed.values()
+                 if is_pinned)
+    moving = set()
+    for source in sources:
+        location = source.split('#')[0].split('?')[0]
+        if MOVING_SOURCE.search(location) or (
+                preflight.classify(source) == 'vcs' and
+                '@' not in location.rsplit('/', 1)[-1]) or (
+                source in parsed and parsed[source][0] not in pinned):
+            moving.add(source)
+    return sorted(moving)
+
+
+def _is_cacheable(modules, requirements):
+    """returns whether the package can be fetched from and published to
+    the cache, i.e. whether its fingerprint identifies its contents
+    """
+    if requirements is None:
+        lgr.warning('Not using the cache, as the requirements file could '
+                    'not be read')
+        return False
+    moving = _moving_sources(modules, requirements)
+    if moving:
+        lgr.warning('Not using the cache, as these sources may change '
+                    'without the config changing (pin them to a release '
+                    'to use it): {0}'.format(', '.join(moving)))
+        return False
+    return True
+
+
+def _fingerprint(config, modules, name_params, python, requirements=None):
+    """returns a key identifying the contents of the package to build
+
+    The key covers the merged modules, the contents of the requirements
+    files, the config options affecting the package's contents, the
+    distribution and the interpreter. Note that sources such as
+    `master.tar.gz` urls and unpinned requirements are identified by their
+    text only, so packages using them aren't cached (see `_is_cacheable`).
+    :param config: the config object.
+    :param dict modules: the merged modules.
+    :param dict name_params: the distribution and version parameters.
+    :param string python: python binary path to use.
+    :param dict requirements: the contents of the requirements files, see
+     `_read_requirements`.
+    """
+    options = {}
+    for section in config.sections():
+        ignored = FINGERPRINT_IGNORED_OPTIONS.get(section, ())
+        if ignored is None:
+            continue
+        options[section] = dict(
+            (name, value) for name, value in config.items(section)
+            if name not in ignored)
+    data = json.dumps({
+        'modules': modules,
+        'options': options,
+        'distro': name_params['distro'],
+        'release': name_params['release'],
+        'python': utils.get_interpreter_id(python),
+        'requirements': None if requirements is None else dict(
+            (path, hashlib.sha256(content.encode('utf-8')).hexdigest())
+            for path, content in requirements.items()),
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _estimate_venv_size(checks):
+    """returns a rough estimate of the size of the virtualenv, in bytes
+
+    :param list checks: the results of the preflight check, which include
+     the download sizes of the sources, if known.
+    """
+    size = BASE_VENV_SIZE
+    for check in checks:
+        if check.origin == 'requirements_file':
+            continue
+        if check.size:
+            size += check.size * SOURCE_EXPANSION
+        else:
+            size += UNKNOWN_SOURCE_SIZE
+    return size
+
+
+def _load_builds(config):
+    """returns the previous builds recorded in the `history` database or,
+    if there is none, the `timings` file of the `build` section
+    """
+    history_file = get_option(config, 'build', 'history')
+    if history_file:
+        return history.load_builds(history_file)
+    timings_file = get_option(config, 'build', 'timings')
+    if timings_file:
+        return estimate.load_builds(timings_file)
+    return []
+
+
+def _make_workspace(config, checks, fingerprint=None):
+    """returns a directory to build the virtualenv in, or None if it should
+    be built in the current directory
+
+    The `workspace` config object in the `build` section can be `disk`
+    (the default), `memory`, to always build in a memory backed filesystem
+    (`memory_path`, /dev/shm by default), or `auto`, to do so only if the
+    estimated size of the virtualenv fits in the available memory. The size
+    is `size_estimate`, if set, or the size of previous builds of the same
+    config, if recorded, or else estimated from the preflight check. If the
+    size is unknown, the virtualenv is built on disk.
+    :param config: the config object.
+    :param list checks: the results of the preflight check, or None.
+    :param string fingerprint: the fingerprint of the package.
+    """
+    mode = get_option(config, 'build', 'workspace') or 'disk'
+    if mode == 'disk':
+        return None
+    if mode not in ('auto', 'memory'):
+        raise exceptions.ConfigFileError(
+            'Unknown workspace: {0}'.format(mode))
+    memory_path = get_option(config, 'build', 'memory_path') or \
+        DEFAULT_MEMORY_WORKSPACE
+    if not os.path.isdir(memory_path):
+        if mode == 'memory':
+            raise exceptions.ConfigFileError(
+                'No such directory: {0}'.format(memory_path))
+        lgr.info('{0} not found, building on disk'.format(memory_path))
+        return None
+
+    if mode == 'auto':
+        size = get_option(config.getint, 'build', 'size_estimate')
+        if size:
+            size *= 1024 ** 2
+        else:
+            size = estimate.predict(
+                _load_builds(config), fingerprint)['venv_size']
+        if not size and checks is not None:
+            size = _estimate_venv_size(checks)
+        if not size:
+            lgr.info('The size of the virtualenv is unknown, '
+                     'building on disk')
+            return None
+        available = utils.get_available_memory(memory_path)
+        lgr.info('Estimated virtualenv size is {0}MB, {1}MB available in '
+                 '{2}'.format(size // 1024 ** 2, available // 1024 ** 2,
+                              memory_path))
+        if size * MEMORY_MARGIN > available:
+            lgr.info('Not enough memory, building on disk')
+            return None
+
+    workspace = tempfile.mkdtemp(prefix='cfy-ap-', dir=memory_path)
+    lgr.info('Building in {0}'.format(workspace))
+    return workspace
+
+
+def _get_cache(config, no_cache=False, chunks=None, stream=False):
+    """returns the cache to fetch the package from and publish it to,
+    or None if the package isn't cached
+
+    Chunked packages and packages with a separate debug archive are not
+    cached, as the cache only holds a single tar.gz file per package.
+    Neither are streamed packages, which aren't written to disk.
+    """
+    cache_url = get_option(config, 'cache', 'url')
+    debug_archive = get_option(
+        config.getboolean, 'output', 'strip_debug_symbols') and \
+        get_option(config, 'output', 'debug_archive')
+    if not cache_url or no_cache or chunks or debug_archive or stream:
+        return None
+    return cache.get_cache(cache_url)
+
+
+def _get_archive_size(destination_tar, chunks=None):
+    if chunks:
+        _, paths = utils.get_chunk_paths(destination_tar, chunks)
+        return sum(os.path.getsize(path) for path in paths)
+    return os.path.getsize(destination_tar)
+
+
+def _format_size(size):
+    if size < 1024 ** 2:
+        return '{0:.0f}KB'.format(size / 1024.0)
+    return '{0:.1f}MB'.format(size / 1024.0 ** 2)
+
+
+def _get_cached_sources(config, fingerprint, checks, resume=False):
+    """returns the sources which wouldn't be downloaded, mapped to where
+    they would be taken from: `wheelhouse`, if the wheel installer would
+    find them there, or `checkpoint`, if the interrupted build to resume
+    installed them already
+    """
+    wheelhouse = None
+    if get_option(config, 'install', 'installer') == \
+            installers.WheelInstaller.name:
+        wheelhouse = get_option(config, 'install', 'wheelhouse')
+    checkpoint = resume and Checkpoint.load(CHECKPOINT_FILE, fingerprint)
+    cached = {}
+    for check in checks:
+        if checkpoint and checkpoint.is_installed(check.source):
+            cached[check.source] = 'checkpoint'
+        elif check.kind != 'path' and \
+                installers.find_cached(wheelhouse, check.source):
+            cached[check.source] = 'wheelhouse'
+    return cached
+
+
+def _estimate(config, modules, fingerprint, artifact_cache=None,
+              no_preflight=False, resume=False):
+    """estimates the cost of building the package, without building it
+
+    The sources are checked as in the preflight check, also looking up the
+    download sizes of requirements on PyPI. Sources available locally (see
+    `_get_cached_sources`) are not counted as downloads. Sizes and
+    durations are predicted from the builds recorded in the `history`
+    database or, if there is none, the `timings` file (see the `build`
+    section), if any, preferring builds of the same config.
+    Otherwise, the size of the virtualenv is estimated from the download
+    sizes (see `_estimate_venv_size`), and the duration is unknown.
+    :param config: the config object.
+    :param dict modules: the merged modules.
+    :param string fingerprint: the fingerprint of the package.
+    :param artifact_cache: the cache the package would be fetched from.
+    :param bool no_preflight: whether to skip checking the sources.
+    :param bool resume: whether the build would resume an interrupted one.
+    :return: dict of the sources' checks and where they are cached, and
+     the download size, the number of sources of unknown size, whether
+     the package is cached, the virtualenv and package sizes, and the
+     duration of the build and of its stages, which are None if unknown
+    """
+    lgr.info('Estimating the cost of the build...')
+    checks = []
+    if not no_preflight:
+        checks = preflight.run(modules, sizes=True)
+    # the requirements file itself isn't installed
+    sources = [check for check in checks
+               if not check.origin == 'requirements_file']
+    cached = _get_cached_sources(config, fingerprint, checks, resume)
+    remote = [check for check in sources
+              if check.kind != 'path' and check.source not in cached]
+    result = {
+        'sources': [{'source': check.source, 'origin': check.origin,
+                     'kind': check.kind, 'size': check.size,
+                     'error': check.error, 'cache': cached.get(check.source)}
+                    for check in checks],
+        'download_size': sum(check.size or 0 for check in remote),
+        'unknown_sizes': len([check for check in remote if not check.size]),
+        'cached': False,
+    }
+    lines = []
+    for check in checks:
+        if check.error:
+            status = 'FAILED: {0}'.format(check.error)
+        elif check.kind == 'path':
+            status = 'local'
+        elif cached.get(check.source) == 'wheelhouse':
+            status = 'in the wheelhouse'
+        elif cached.get(check.source) == 'checkpoint':
+            status = 'installed by the interrupted build'
+        elif check.size:
+            status = _format_size(check.size)
+        else:
+            status = 'unknown size'
+        lines.append('{0} ({1}): {2}'.format(
+            check.source, check.origin, status))
+    if lines:
+        lgr.info('Sources:\n{0}'.format('\n'.join(lines)))
+    failed = [check for check in checks if check.error]
+    if failed:
+        lgr.warning('{0} of {1} sources are unavailable'.format(
+            len(failed), len(checks)))
+    lgr.info('To download: {0} from {1} sources ({2} of unknown '
+             'size)'.format(_format_size(result['download_size']),
+                            len(remote), result['unknown_sizes']))
+
+    if artifact_cache:
+        try:
+            result['cached'] = artifact_cache.contains(fingerprint)
+        except Exception as e:
+            lgr.warning('Could not look up the package in cache {0}: '
+                        '{1}'.format(artifact_cache, e))
+        if result['cached']:
+            lgr.info('The package would be fetched from cache {0} instead '
+                     'of being built'.format(artifact_cache))
+
+    prediction = estimate.predict(_load_builds(config), fingerprint)
+    if prediction['matching']:
+        based_on = 'the last {0} builds of this config'.format(
+            prediction['builds'])
+    else:
+        based_on = 'the last {0} builds'.format(prediction['builds'])
+
+    venv_size = prediction['venv_size']
+    if venv_size:
+        lgr.info('Expected virtualenv size: {0}, based on {1}'.format(
+            _format_size(venv_size), based_on))
+    else:
+        venv_size = get_option(config.getint, 'build', 'size_estimate')
+        if venv_size:
+            venv_size *= 1024 ** 2
+        else:
+            venv_size = _estimate_venv_size(sources)
+        lgr.info('Expected virtualenv size: {0} (rough estimate)'.format(
+            _format_size(venv_size)))
+    archive_size = venv_size * (
+        prediction['archive_ratio'] or estimate.ARCHIVE_RATIO)
+    lgr.info('Expected package size: {0}'.format(_format_size(archive_size)))
+    result.update({
+        'venv_size': int(venv_size),
+        'archive_size': int(archive_size),
+        'duration': prediction['duration'],
+        'stages': prediction['stages'],
+    })
+
+    if prediction['duration'] is None:
+        lgr.info('Build time is unknown, as no previous builds were '
+                 'recorded (see `timings` in the `build` section)')
+    else:
+        lgr.info('Expected build time: {0:.0f}s, based on {1}:\n'
+                 '{2}'.format(prediction['duration'], based_on, '\n'.join(
+                     '{0}: {1:.1f}s'.format(name, duration) for name, duration
+                     in sorted(prediction['stages'].items(),
+                               key=lambda item: -item[1]))))
+    return result
 
 
 def _set_defaults():
@@ -138,6 +599,7 @@ def _set_defaults():
     modules = {}
     modules['additional_modules'] = []
     modules['additional_plugins'] = {}
+    modules['exclude_modules'] = []
     modules['agent'] = ''
     return modules
 
@@ -153,6 +615,12 @@ def _merge_modules(modules, config):
     modules['requirements_file'] = get_option(
         config, 'install', 'requirements_file')
 
+    try:
+        for pattern, _empty in config.items('exclude_modules'):
+            modules['exclude_modules'].append(pattern)
+    except NoSectionError:
+        pass
+
     try:
         for name, _empty in config.items('additional_modules'):
             modules['additional_modules'].append(name)
@@ -182,6 +650,28 @@ def _merge_modules(modules, config):
     return modules
 
 
+def _preflight(modules, jobs=preflight.DEFAULT_JOBS):
+    """checks that all sources of the modules to install are available
+
+    All remote sources are checked concurrently, so that a bad source
+    fails the build before the virtualenv is created.
+    :param dict modules: dict containing core and additional
+    modules and the cloudify-agent module.
+    :param int jobs: the number of checks to run concurrently.
+    """
+    lgr.info('Checking module sources...')
+    checks = preflight.run(modules, jobs=jobs)
+    failed = [check for check in checks if check.error]
+    lgr.info('Checked {0} sources:\n{1}'.format(
+        len(checks), '\n'.join(str(check) for check in checks)))
+    if failed:
+        raise exceptions.PreflightError(
+            '{0} of {1} sources are unavailable:\n{2}'.format(
+                len(failed), len(checks),
+                '\n'.join(str(check) for check in failed)))
+    return checks
+
+
 def _validate(modules, venv):
     """validates that all requested modules are actually installed
     within the virtualenv
@@ -207,21 +697,243 @@ def _validate(modules, venv):
             .format(failed))
 
 
+def _validate_imports(modules, venv, budget=None, report_file=None):
+    """validates that the top level modules of all requested modules
+    can actually be imported within the virtualenv
+
+    This catches broken installations (e.g. missing native libraries)
+    that don't show in the list of installed distributions.
+    :param dict modules: dict containing core and additional
+    modules and the cloudify-agent module.
+    :param string venv: path of virtualenv to install in.
+    :param float budget: maximum total import time, in seconds.
+    :param string report_file: path to write the JSON results to.
+    """
+    lgr.info('Validating installation by importing modules...')
+    results = utils.check_imports(modules['plugins'] + modules['modules'],
+                                  venv)
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+
+    failed = []
+    for module_name, result in sorted(results.items()):
+        if result['error']:
+            lgr.error('Could not import {0}: {1}'.format(
+                module_name, result['error']))
+            failed.append(module_name)
+        for name, module in sorted(result['modules'].items()):
+            if module['error']:
+                lgr.error('Could not import {0} (of {1}): {2}'.format(
+                    name, module_name, module['error']))
+                failed.append(module_name)
+            else:
+                lgr.info('Imported {0} (of {1}) in {2:.3f}s'.format(
+                    name, module_name, module['time']))
+    if failed:
+        raise exceptions.ImportCheckError(
+            'some of the requested modules could not be imported: {0}'
+            .format(sorted(set(failed))))
+
+    total_time = sum(result['time'] for result in results.values())
+    lgr.info('Importing all modules took {0:.3f}s'.format(total_time))
+    if budget is not None and total_time > budget:
+        slowest = sorted(results, key=lambda m: results[m]['time'],
+                         reverse=True)
+        raise exceptions.ImportCheckError(
+            'importing took {0:.3f}s, exceeding the budget of {1}s. '
+            'Slowest modules: {2}'.format(
+                total_time, budget, ', '.join(slowest[:3])))
+
+
+def _exclude(modules, venv, patterns):
+    """uninstalls all distributions matching the exclusion patterns, except
+    for the requested modules and anything any kept distribution requires
+
+    :param dict modules: dict containing core and additional
+    modules and the cloudify-agent module.
+    :param string venv: path of virtualenv to install in.
+    :param list patterns: glob patterns of distribution names to exclude.
+    :return: dict mapping each excluded distribution to its size in bytes
+    """
+    lgr.info('Excluding modules...')
+    distributions = dict(
+        (get_module_name(dist['name']).lower(), dist)
+        for dist in utils.get_distributions(venv))
+    patterns = [get_module_name(pattern).lower() for pattern in patterns]
+    matched = set(name for name in distributions
+                  if any(fnmatch.fnmatch(name, p) for p in patterns))
+    # pip is still needed to validate the installation
+    required = set(get_module_name(name).lower() for name in
+                   modules['plugins'] + modules['modules'] + ['pip'])
+
+    excluded = matched - required
+    while True:
+        # anything required by a kept distribution is kept too
+        kept = set(distributions) - excluded
+        pending = list(kept)
+        while pending:
+            dist = distributions.get(pending.pop())
+            for name in dist['requires'] if dist else []:
+                name = get_module_name(name).lower()
+                if name not in kept:
+                    kept.add(name)
+                    pending.append(name)
+        if not excluded & kept:
+            break
+        excluded -= kept
+
+    for name in sorted(matched - excluded):
+        lgr.warning('Not excluding {0}, as it is required by kept '
+                    'modules'.format(distributions[name]['name']))
+    if not excluded:
+        lgr.info('No modules to exclude')
+        return {}
+
+    sizes = dict((distributions[name]['name'], distributions[name]['size'])
+                 for name in excluded)
+    utils.uninstall_modules(sorted(sizes), venv)
+    for name, size in sorted(sizes.items()):
+        lgr.info('Excluded {0} ({1} bytes)'.format(name, size))
+    lgr.info('Excluded {0} modules, removing {1} bytes'.format(
+        len(sizes), sum(sizes.values())))
+    return sizes
+
+
+def _zip_site_packages(modules, venv):
+    """bundles the pure python distributions of the virtualenv into a
+    single zip file, to reduce the number of files probed on import
+
+    The requested modules are imported before and after zipping, both to
+    make sure that zipping didn't break them and to report the change in
+    import time.
+    :param dict modules: dict containing core and additional
+    modules and the cloudify-agent module.
+    :param string venv: path of virtualenv to install in.
+    """
+    lgr.info('Zipping site-packages...')
+    names = modules['plugins'] + modules['modules']
+    before = utils.check_imports(names, venv)
+    result = utils.zip_site_packages(venv, ZIPPED_SITE_PACKAGES)
+    for info_dir, reason in sorted(result['kept'].items()):
+        lgr.debug('Not zipping {0}: {1}'.format(info_dir, reason))
+    lgr.info('Zipped {0} distributions ({1} files) into {2}, kept {3} '
+             'unzipped'.format(len(result['zipped']),
+                               result['files_removed'], result['zip'],
+                               len(result['kept'])))
+    after = utils.check_imports(names, venv)
+
+    def _failed(result):
+        return result['error'] or any(
+            module['error'] for module in result['modules'].values())
+    broken = [name for name in names
+              if _failed(after[name]) and not _failed(before[name])]
+    if broken:
+        raise exceptions.ImportCheckError(
+            'zipping site-packages broke the import of: {0}'.format(broken))
+
+    time_before = sum(result['time'] for result in before.values())
+    time_after = sum(result['time'] for result in after.values())
+    lgr.info('Importing all modules took {0:.3f}s before zipping '
+             'and {1:.3f}s after'.format(time_before, time_after))
+    return result
+
+
+def _strip_debug_symbols(venv, debug_dir=None, jobs=None):
+    """strips the debug sections of all shared objects in the virtualenv
+    concurrently
+
+    :param string venv: path of the virtualenv.
+    :param string debug_dir: if given, the debug sections of every shared
+     object are kept in this directory, under the same relative path as the
+     shared object with a `.debug` suffix.
+    :param int jobs: the number of files to strip concurrently, defaults
+     to the number of cpus.
+    :return: the number of bytes saved
+    """
+    lgr.info('Stripping debug symbols...')
+    shared_objects = utils.find_shared_objects(venv)
+    if not shared_objects:
+        lgr.info('No shared objects found')
+        return 0
+
+    def _strip(path):
+        debug_file = None
+        if debug_dir:
+            debug_file = os.path.join(
+                debug_dir, os.path.relpath(path, venv) + '.debug')
+            if not os.path.isdir(os.path.dirname(debug_file)):
+                try:
+                    os.makedirs(os.path.dirname(debug_file))
+                except OSError:
+                    # created concurrently for another file
+                    if not os.path.isdir(os.path.dirname(debug_file)):
+                        raise
+        saved = utils.strip_debug_symbols(path, debug_file)
+        if saved:
+            lgr.debug('Stripped {0} bytes from {1}'.format(saved, path))
+        return saved
+
+    pool = ThreadPool(min(jobs or multiprocessing.cpu_count(),
+                          len(shared_objects)))
+    try:
+        saved = pool.map(_strip, shared_objects)
+    finally:
+        pool.close()
+        pool.join()
+    lgr.info('Stripped {0} of {1} shared objects, saving {2} bytes'.format(
+        len([size for size in saved if size]), len(shared_objects),
+        sum(saved)))
+    return sum(saved)
+
+
 class ModuleInstaller:
-    def __init__(self, modules, venv, final_set):
+    def __init__(self, modules, venv, final_set, sources=None,
+                 checkpoint=None, backend=None):
         self.venv = venv
         self.modules = modules
         self.final_set = final_set
+        # maps remote sources to local copies of them
+        self.sources = sources or {}
+        self.checkpoint = checkpoint
+        # installs the modules, see `installers`
+        self.backend = backend or installers.PipInstaller(venv)
+
+    def _install(self, module):
+        """installs a module, unless a previous, interrupted build
+        already did
+        """
+        if self.checkpoint and self.checkpoint.is_installed(module):
+            lgr.info('{0} was already installed'.format(module))
+            return
+        self.backend.install(self.sources.get(module, module))
+        if self.checkpoint:
+            self.checkpoint.install(module)
 
     def install_requirements_file(self):
-        if 'requirements_file' in self.modules:
-            utils.install_requirements_file(
-                self.modules['requirements_file'], self.venv)
+        if self.modules.get('requirements_file'):
+            self.backend.install_requirements_file(
+                self.modules['requirements_file'])
 
     def install_modules(self, modules):
-        for module in modules:
-            lgr.info('Installing module {0}'.format(module))
-            utils.install_module(module, self.venv)
+        """installs modules together, so that the backend can install
+        them concurrently
+        """
+        if self.checkpoint:
+            for module in modules:
+                if self.checkpoint.is_installed(module):
+                    lgr.info('{0} was already installed'.format(module))
+            modules = [module for module in modules
+                       if not self.checkpoint.is_installed(module)]
+        if not modules:
+            return
+        lgr.info('Installing modules {0}'.format(', '.join(modules)))
+        self.backend.install_modules(
+            [self.sources.get(module, module) for module in modules])
+        if self.checkpoint:
+            for module in modules:
+                self.checkpoint.install(module)
 
     def install_additional_plugins(self):
         lgr.info('Installing additional plugins...')
@@ -231,34 +943,274 @@ class ModuleInstaller:
             module_name = get_module_name(module)
             lgr.info('Installing module {0} from {1}.'.format(
                 module_name, source))
-            utils.install_module(source, self.venv)
+            self._install(source)
             self.final_set['plugins'].append(module_name)
 
     def install_agent(self):
         lgr.info('Installing cloudify-agent module from {0}'.format(
             self.modules['agent']))
-        utils.install_module(self.modules['agent'], self.venv)
+        self._install(self.modules['agent'])
         self.final_set['modules'].append('cloudify-agent')
 
 
-def _install(modules, venv, final_set):
-    """installs all requested modules
+def _fetch_sources(modules, destination, jobs=preflight.DEFAULT_JOBS,
+                   skip=()):
+    """downloads the remote archives of the plugins and the agent
+    concurrently, so that this can be done while the virtualenv is created
+
+    :param dict modules: dict containing core and additional
+    modules and the cloudify-agent module.
+    :param string destination: directory to download to.
+    :param list skip: sources not to download, e.g. as they are already
+     installed.
+    :return: dict mapping each downloaded url to its local copy
+    """
+    urls = set(source for source in
+               list(modules['additional_plugins'].values()) +
+               [modules['agent']]
+               if source not in skip and
+               source.startswith(('http://', 'https://')) and
+               source.split('?')[0].endswith(preflight.ARCHIVE_SUFFIXES))
+    sources = {}
+    for i, url in enumerate(sorted(urls)):
+        # keep the original name, which pip may rely on (e.g. for wheels)
+        path = os.path.join(destination, str(i))
+        os.makedirs(path)
+        sources[url] = os.path.join(
+            path, url.split('?')[0].rstrip('/').split('/')[-1])
+    if not sources:
+        return sources
+    lgr.info('Downloading {0} sources...'.format(len(sources)))
+    pool = ThreadPool(min(jobs, len(sources)))
+    try:
+        pool.map(lambda url: utils.download_file(url, sources[url]),
+                 list(sources))
+    finally:
+        pool.close()
+        pool.join()
+    return sources
+
+
+class Build(object):
+    """The stages of building an agent package.
+
+    Each stage is a method, and `stages` declares what each of them
+    requires and provides, so that independent stages can run
+    concurrently (see `scheduler.Scheduler`), e.g. downloading sources
+    while the virtualenv is created, or validating the installation while
+    it is archived.
+    :param config: the config object.
     :param dict modules: dict containing core and additional
     modules and the cloudify-agent module.
     :param string venv: path of virtualenv to install in.
-    :param dict final_set: dict to populate with modules.
+    :param string python: python binary path to use.
+    :param string destination_tar: path of the package to create, or `-`
+     or an http url to stream it to (see `_is_stream`).
+    :param string workdir: directory to download sources to.
+    :param tuple cache_entry: the cache and key to publish the package
+     to, or None.
+    :param checkpoint: a `checkpoint.Checkpoint` recording the progress of
+     the build, or None.
     """
-    installer = ModuleInstaller(modules, venv, final_set)
-    lgr.info('Installing modules required by setup...')
-    installer.install_modules(['setuptools==36.8.0'])
-    lgr.info('Installing module from requirements file...')
-    installer.install_requirements_file()
-    lgr.info('Installing external modules...')
-    lgr.info('Installing additional modules...')
-    installer.install_modules(modules['additional_modules'])
-    installer.install_additional_plugins()
-    installer.install_agent()
-    return installer.final_set
+    # the stages modifying the virtualenv, which a resumed build skips if
+    # they were completed. The other installation stages are run again,
+    # only installing what wasn't installed before, as they keep track of
+    # the installed modules.
+    RESUMABLE_STAGES = ('make_venv', 'install_setuptools',
+                        'install_requirements', 'install_modules', 'exclude',
+                        'strip', 'relocate', 'zip')
+
+    def __init__(self, config, modules, venv, python, destination_tar,
+                 workdir, force=False, no_validate=False, validation=None,
+                 chunks=None, cache_entry=None, checkpoint=None):
+        self.config = config
+        self.modules = modules
+        self.venv = venv
+        self.python = python
+        self.destination_tar = destination_tar
+        # the size of the package, once archived, if known
+        self.archive_size = None
+        self.workdir = workdir
+        self.force = force
+        self.chunks = chunks
+        self.cache_entry = cache_entry
+        self.validation = None
+        if not no_validate:
+            self.validation = validation or \
+                get_option(config, 'validate', 'mode') or 'freeze'
+            if self.validation not in ('freeze', 'imports'):
+                raise exceptions.ConfigFileError(
+                    'Unknown validation mode: {0}'.format(self.validation))
+        self.zip = get_option(
+            config.getboolean, 'output', 'zip_site_packages')
+        self.strip = get_option(
+            config.getboolean, 'output', 'strip_debug_symbols')
+        self.debug_archive = get_option(config, 'output', 'debug_archive')
+        # this will be updated with installed plugins and modules and used
+        # to validate the installation
+        self.final_set = {'modules': [], 'plugins': []}
+        self.checkpoint = checkpoint
+        backend = installers.get_installer(
+            get_option(config, 'install', 'installer') or
+            installers.PipInstaller.name,
+            venv, get_option(config, 'install', 'wheelhouse'))
+        self.installer = ModuleInstaller(modules, venv, self.final_set,
+                                         checkpoint=checkpoint,
+                                         backend=backend)
+
+    def stages(self):
+        stages = [
+            Stage('make_venv', self.make_venv, outputs=['venv']),
+            Stage('fetch_sources', self.fetch_sources, outputs=['sources']),
+            Stage('install_setuptools', self.install_setuptools,
+                  ['venv'], ['setuptools']),
+            Stage('install_requirements', self.install_requirements,
+                  ['setuptools'], ['requirements']),
+            Stage('install_modules', self.install_modules,
+                  ['requirements'], ['additional_modules']),
+            Stage('install_plugins', self.install_plugins,
+                  ['additional_modules', 'sources'], ['plugins']),
+            Stage('install_agent', self.install_agent,
+                  ['plugins'], ['agent']),
+        ]
+        installed = 'agent'
+        if self.modules['exclude_modules']:
+            stages.append(Stage('exclude', self.exclude,
+                                [installed], ['excluded']))
+            installed = 'excluded'
+        if self.strip:
+            stages.append(Stage('strip', self.strip_debug_symbols,
+                                [installed], ['stripped']))
+            installed = 'stripped'
+        stages.append(Stage('relocate', self.relocate,
+                            [installed], ['relocated']))
+        installed = 'relocated'
+        if self.zip:
+            stages.append(Stage('zip', self.zip_site_packages,
+                                [installed], ['zipped']))
+            installed = 'zipped'
+
+        # all of these only read the virtualenv. A package written to a file
+        # is archived while validating, and removed if validation fails,
+        # but a streamed package can't be taken back once it's sent.
+        archive_inputs = [installed]
+        if self.validation and _is_stream(self.destination_tar):
+            archive_inputs.append('validated')
+        stages.append(Stage('archive', self.archive, archive_inputs,
+                            ['archive']))
+        stages.append(Stage('list_installed', self.list_installed,
+                            [installed], ['installed']))
+        if self.validation:
+            stages.append(Stage('validate', self.validate,
+                                [installed], ['validated']))
+        if self.cache_entry:
+            stages.append(Stage(
+                'publish', self.publish,
+                ['archive'] + (['validated'] if self.validation else []),
+                ['published']))
+        return stages
+
+    def completed_stages(self):
+        """returns the stages completed by a previous, interrupted build
+        """
+        if not self.checkpoint:
+            return []
+        return [name for name in self.checkpoint.stages
+                if name in self.RESUMABLE_STAGES]
+
+    def on_complete(self, stage):
+        if self.checkpoint and stage.name in self.RESUMABLE_STAGES:
+            self.checkpoint.complete_stage(stage.name)
+
+    def make_venv(self):
+        _make_venv(self.venv, self.python, self.force)
+
+    def fetch_sources(self):
+        self.installer.sources = _fetch_sources(
+            self.modules, self.workdir,
+            skip=self.checkpoint.installed if self.checkpoint else ())
+
+    def install_setuptools(self):
+        lgr.info('Installing modules required by setup...')
+        self.installer.install_modules(['setuptools==36.8.0'])
+
+    def install_requirements(self):
+        lgr.info('Installing module from requirements file...')
+        self.installer.install_requirements_file()
+
+    def install_modules(self):
+        lgr.info('Installing additional modules...')
+        self.installer.install_modules(self.modules['additional_modules'])
+
+    def install_plugins(self):
+        self.installer.install_additional_plugins()
+
+    def install_agent(self):
+        self.installer.install_agent()
+
+    def exclude(self):
+        _exclude(self.final_set, self.venv, self.modules['exclude_modules'])
+
+    def strip_debug_symbols(self):
+        debug_dir = None
+        if self.debug_archive:
+            debug_dir = os.path.join(self.workdir, 'debug')
+        _strip_debug_symbols(self.venv, debug_dir)
+        if debug_dir and os.path.isdir(debug_dir):
+            digest, _ = utils.tar(debug_dir, self.debug_archive,
+                                  arcname=DEFAULT_VENV_PATH)
+            lgr.info('Debug symbols archive sha256: {0}'.format(digest))
+
+    def relocate(self):
+        utils.virtualenv_relocatable(self.venv, self.python)
+
+    def zip_site_packages(self):
+        _zip_site_packages(self.final_set, self.venv)
+
+    def validate(self):
+        if self.validation == 'imports':
+            _validate_imports(
+                self.final_set, self.venv,
+                budget=get_option(
+                    self.config.getfloat, 'validate', 'import_time_budget'),
+                report_file=get_option(self.config, 'validate', 'report'))
+        else:
+            _validate(self.final_set, self.venv)
+
+    def archive(self):
+        # the virtualenv is always archived as DEFAULT_VENV_PATH, wherever
+        # it was built
+        if self.chunks:
+            utils.tar_chunks(self.venv, self.destination_tar, self.chunks,
+                             arcname=DEFAULT_VENV_PATH)
+            self.archive_size = _get_archive_size(
+                self.destination_tar, self.chunks)
+            return
+        if self.destination_tar == '-':
+            lgr.info('Writing tar file to stdout')
+            stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+            digest, _ = utils.write_tar(self.venv, stdout,
+                                        arcname=DEFAULT_VENV_PATH,
+                                        name=STREAMED_ARCHIVE_NAME)
+            stdout.flush()
+        elif _is_stream(self.destination_tar):
+            digest, files = utils.upload_tar(self.venv, self.destination_tar,
+                                             arcname=DEFAULT_VENV_PATH)
+            utils.upload_sidecars(self.destination_tar, digest, files)
+        else:
+            digest, files = utils.tar(self.venv, self.destination_tar,
+                                      arcname=DEFAULT_VENV_PATH)
+            utils.write_sidecars(self.destination_tar, digest, files)
+            self.archive_size = _get_archive_size(self.destination_tar)
+        lgr.info('Archive sha256: {0}'.format(digest))
+
+    def publish(self):
+        cache.publish(self.cache_entry[0], self.cache_entry[1],
+                      self.destination_tar)
+
+    def list_installed(self):
+        lgr.info('The following modules and plugins were installed '
+                 'in the agent:\n{0}'.format(utils.get_installed(self.venv)))
 
 
 def get_module_name(module):
@@ -276,6 +1228,46 @@ def get_os_props():
     return data[0], data[2]
 
 
+def _get_name_params(config):
+    """returns the distribution and version parameters of the package,
+    from the config, the environment, or the current system
+    """
+    name_params = {
+        'distro': get_option(config, 'system', 'distribution'),
+        'release': get_option(config, 'system', 'release'),
+        'version': (get_option(config, 'output', 'version') or
+                    os.environ.get('VERSION', None)),
+        'milestone': (get_option(config, 'output', 'milestone') or
+                      os.environ.get('PRERELEASE', None)),
+        'build': (get_option(config, 'output', 'build') or
+                  os.environ.get('BUILD', None)),
+    }
+    if not name_params['distro'] or not name_params['release']:
+        try:
+            distro, release = get_os_props()
+        except Exception as ex:
+            raise exceptions.AgentPackagerError(
+                'Distribution not found in configuration '
+                'and could not be retrieved automatically. '
+                'please specify the distribution in the config.file. '
+                '({0})'.format(ex))
+        name_params.update({
+            'distro': distro,
+            'release': release
+        })
+    return name_params
+
+
+def _get_fingerprint(config):
+    """returns the fingerprint of the package a config builds, see
+    `_fingerprint`
+    """
+    modules = _merge_modules(_set_defaults(), config)
+    return _fingerprint(config, modules, _get_name_params(config),
+                        get_option(config, 'system', 'python_path'),
+                        _read_requirements(modules))
+
+
 def _name_archive(distro, release, version, milestone, build):
     destination_tar = ''
     destination_tar += '{0}-'.format(distro)
@@ -291,8 +1283,135 @@ def _name_archive(distro, release, version, milestone, build):
     return destination_tar
 
 
+def verify(archive):
+    """Verifies an agent package against its manifest file
+    """
+    utils.verify_tar(archive)
+
+
+def check(config=None, config_file=None, verbose=True,
+          jobs=preflight.DEFAULT_JOBS):
+    """Checks that all sources in the config are available,
+    without creating an agent package.
+    """
+    set_global_verbosity_level(verbose)
+    if not config:
+        config = _import_config(config_file)
+    modules = _merge_modules(_set_defaults(), config)
+    _preflight(modules, jobs=jobs)
+    lgr.info('All sources are available')
+
+
+def show_history(config=None, config_file=None, path=None, last=10,
+                 baseline=history.DEFAULT_BASELINE, thresholds=None,
+                 fingerprint=None, verbose=False):
+    """Shows the trends of the builds recorded in the history database,
+    and checks them for regressions.
+
+    Every build's duration, package size and stage durations are compared
+    to the median of the `baseline` builds of the same fingerprint
+    preceding it. Increases beyond the `thresholds` (see `history.compare`)
+    are reported as regressions, along with the distributions which were
+    added or grew since the previous build.
+    If a config is given, only the builds of its fingerprint are shown.
+    :param string path: path of the history database, instead of the one
+     in the config.
+    :param int last: the number of most recent builds to show.
+    :param string fingerprint: only show builds of this fingerprint, or
+     of fingerprints starting with it, instead of the config's.
+    :return: the regressions of the most recent build, as messages
+    """
+    set_global_verbosity_level(verbose)
+    if not config and config_file:
+        config = _import_config(config_file)
+    if config:
+        path = path or get_option(config, 'build', 'history')
+        fingerprint = fingerprint or _get_fingerprint(config)
+    if not path:
+        raise exceptions.ConfigFileError(
+            'No history database set in the build section')
+    if not os.path.isfile(path):
+        raise exceptions.ConfigFileError('No such file: {0}'.format(path))
+    # without a fingerprint, the baseline of every build may be anywhere
+    builds = history.load_builds(
+        path, fingerprint, last + baseline if fingerprint else None,
+        packages=True)
+    if not builds:
+        lgr.info('No builds recorded in {0}{1}'.format(
+            path, ' of config {0}'.format(fingerprint[:8])
+            if fingerprint else ''))
+        return []
+    results = history.check(builds, baseline, thresholds)
+
+    def _change(increase):
+        if increase is None:
+            return ''
+        return ' ({0:+.0f}%)'.format(increase)
+
+    first = max(0, len(builds) - last)
+    lines = []
+    for i in range(first, len(builds)):
+        build, result = builds[i], results[i]
+        lines.append('#{0} {1} {2} {3}{4} {5}{6}{7}'.format(
+            build['id'],
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(build['time'])),
+            (build['fingerprint'] or '-')[:8],
+            '{0:.1f}s'.format(build['duration'])
+            if build['duration'] is not None else '-',
+            _change(result['increases']['duration']),
+            _format_size(build['archive_size'])
+            if build['archive_size'] else '-',
+            _change(result['increases']['archive_size']),
+            ' REGRESSION' if result['regressions'] else ''))
+    lgr.info('Builds in {0} (compared to the median of the {1} builds '
+             'of the same config before each):\n{2}'.format(
+                 path, baseline, '\n'.join(lines)))
+
+    regressions = results[-1]['regressions']
+    if regressions:
+        previous = history.previous_builds(builds, len(builds) - 1)
+        lgr.error('Build #{0} regressed:\n{1}'.format(
+            builds[-1]['id'], '\n'.join(regressions)))
+        changes = history.package_changes(builds[-1], previous[-1])
+        if changes:
+            lgr.info('Changes since build #{0}:\n{1}'.format(
+                previous[-1]['id'], '\n'.join(changes)))
+    else:
+        lgr.info('No regressions in build #{0}'.format(builds[-1]['id']))
+    return regressions
+
+
+def _resume(venv, fingerprint):
+    """returns the checkpoint of an interrupted build to resume, or None
+
+    An interrupted build which used another config, or didn't get to
+    create its virtualenv, can't be resumed. Its virtualenv is removed,
+    so that the build starts over.
+    :param string venv: path of the virtualenv.
+    :param string fingerprint: the fingerprint of the build's config.
+    """
+    if not os.path.isfile(CHECKPOINT_FILE):
+        lgr.info('No interrupted build to resume')
+        return None
+    checkpoint = Checkpoint.load(CHECKPOINT_FILE, fingerprint)
+    if checkpoint and 'make_venv' in checkpoint.stages and \
+            os.path.isdir(venv):
+        lgr.info('Resuming build. Completed stages: {0}. Installed '
+                 'modules: {1}'.format(', '.join(checkpoint.stages),
+                                       ', '.join(checkpoint.installed)))
+        return checkpoint
+    lgr.info('The interrupted build used another config or has no '
+             'virtualenv, starting over')
+    if os.path.isdir(venv):
+        shutil.rmtree(venv)
+    os.remove(CHECKPOINT_FILE)
+    return None
+
+
 def create(config=None, config_file=None, force=False, dryrun=False,
-           no_validate=False, verbose=True):
+           no_validate=False, verbose=True, validation=None,
+           no_preflight=False, no_cache=False, critical_path=False,
+           resume=False, output=None):
     """Creates an agent package (tar.gz)
 
     This will try to identify the distribution of the host you're running on.
@@ -300,69 +1419,47 @@ def create(config=None, config_file=None, force=False, dryrun=False,
     `distribution` (e.g. Ubuntu) config object in the config.yaml.
     The same goes for the `release` (e.g. Trusty).
 
-    A virtualenv will be created under cloudify/env.
-
-    The order of the modules' installation is as follows:
-    cloudify-rest-service
-    cloudify-plugins-common
-    cloudify-script-plugin
-    cloudify-diamond-plugin
-    cloudify-agent
-    any additional modules specified under `additional_modules` in the yaml.
-    any additional plugins specified under `additional_plugins` in the yaml.
-    Once all modules are installed, excluded modules will be uninstalled;
-    installation validation will occur; a tar.gz file will be created.
-    The `output_tar` config object can be specified to determine the path to
-    the output file. If omitted, a default path will be given with the
-    format `DISTRIBUTION-RELEASE-agent.tar.gz`.
+    A virtualenv will be created under cloudify/env (or in memory, see
+    `_make_workspace`), the agent, `additional_modules` and
+    `additional_plugins` will be installed in it, `exclude_modules` will
+    be uninstalled, and the installation will be validated and archived.
+    The build's stages and how they run concurrently are described in
+    `Build`; all config options are documented in config/config.ini.
+    The `output_tar` config object, or `output`, determines the path of
+    the package (or `-` or an http url to stream it to), which defaults
+    to `DISTRIBUTION-RELEASE-agent.tar.gz`. A package built from the same
+    config is fetched from the `cache` instead, unless `no_cache` is set.
+    With `dryrun`, the cost of the build is estimated instead (see
+    `_estimate`), and `resume` continues an interrupted build (see
+    `_resume`). Builds can be recorded for `show_history`.
     """
     set_global_verbosity_level(verbose)
 
-    # this will be updated with installed plugins and modules and used
-    # to validate the installation
-    final_set = {'modules': [], 'plugins': []}
     if not config:
         config = _import_config(config_file)
+    if (output or get_option(config, 'output', 'tar')) == '-':
+        _log_to_stderr()
 
-    name_params = {
-        'distro': get_option(config, 'system', 'distribution'),
-        'release': get_option(config, 'system', 'release'),
-        'version': (get_option(config, 'output', 'version') or
-                    os.environ.get('VERSION', None)),
-        'milestone': (get_option(config, 'output', 'milestone') or
-                      os.environ.get('PRERELEASE', None)),
-        'build': (get_option(config, 'output', 'build') or
-                  os.environ.get('BUILD', None)),
-    }
-    if not name_params['distro'] or not name_params['release']:
-        try:
-            distro, release = get_os_props()
-        except Exception as ex:
-            raise exceptions.AgentPackagerError(
-                'Distribution not found in configuration '
-                'and could not be retrieved automatically. '
-                'please specify the distribution in the config.file. '
-                '({0})'.format(ex))
-        name_params.update({
-            'distro': distro,
-            'release': release
-        })
+    name_params = _get_name_params(config)
 
     python = get_option(config, 'system', 'python_path')
     venv = DEFAULT_VENV_PATH
     venv_already_exists = utils.is_virtualenv(venv)
-    destination_tar = get_option(config, 'output', 'tar',) or \
+    destination_tar = output or get_option(config, 'output', 'tar',) or \
         _name_archive(**name_params)
+    stream = _is_stream(destination_tar)
 
     lgr.debug('Distibution is: {0}'.format(name_params['distro']))
     lgr.debug('Distribution release is: {0}'.format(name_params['release']))
     lgr.debug('Python path is: {0}'.format(python))
     lgr.debug('Destination tarfile is: {0}'.format(destination_tar))
 
-    if not dryrun:
-        _make_venv(venv, python, force)
-
-    _handle_output_file(destination_tar, force)
+    chunks = get_option(config.getint, 'output', 'chunks')
+    if stream and chunks:
+        raise exceptions.ConfigFileError(
+            'A chunked package can only be written to files')
+    if not stream:
+        _handle_output_file(destination_tar, force, chunks)
 
     modules = _set_defaults()
     modules = _merge_modules(modules, config)
@@ -371,23 +1468,96 @@ def create(config=None, config_file=None, force=False, dryrun=False,
         set_global_verbosity_level(True)
     lgr.debug('Modules and plugins to install: {0}'.format(json.dumps(
         modules, sort_keys=True, indent=4, separators=(',', ': '))))
+
+    artifact_cache = _get_cache(config, no_cache, chunks, stream)
+    timings_file = get_option(config, 'build', 'timings')
+    requirements = _read_requirements(modules)
+    fingerprint = _fingerprint(config, modules, name_params, python,
+                               requirements)
+    if artifact_cache and not _is_cacheable(modules, requirements):
+        artifact_cache = None
+
     if dryrun:
+        result = _estimate(config, modules, fingerprint, artifact_cache,
+                           no_preflight, resume)
         lgr.info('Dryrun complete')
-        return
+        return result
 
-    final_set = _install(modules, venv, final_set)
-    utils.virtualenv_relocatable(venv, python)
-    if not no_validate:
-        _validate(final_set, venv)
-    utils.tar(venv, destination_tar)
-
-    lgr.info('The following modules and plugins were installed '
-             'in the agent:\n{0}'.format(utils.get_installed(venv)))
+    if artifact_cache and cache.fetch(
+            artifact_cache, fingerprint, destination_tar):
+        lgr.info('Process complete!')
+        return
 
-    keep_virtualenv = get_option(
-        config.getboolean, 'output', 'keep_virtualenv') or False
-    if not keep_virtualenv and not venv_already_exists:
-        lgr.info('Removing origin virtualenv...')
-        shutil.rmtree(venv)
+    if no_preflight or get_option(
+            config.getboolean, 'install', 'preflight') is False:
+        lgr.info('Skipping preflight check')
+        checks = None
+    else:
+        checks = _preflight(modules)
+
+    checkpoint = None
+    if resume:
+        checkpoint = _resume(venv, fingerprint)
+        # the virtualenv of an interrupted build is removed as usual
+        venv_already_exists = not checkpoint and utils.is_virtualenv(venv)
+
+    workspace = None
+    if not venv_already_exists and not resume:
+        workspace = _make_workspace(config, checks, fingerprint)
+    if workspace:
+        venv = os.path.join(workspace, DEFAULT_VENV_PATH)
+    elif not checkpoint:
+        # so that the build can be resumed if it's interrupted
+        checkpoint = Checkpoint(CHECKPOINT_FILE, fingerprint)
+    workdir = tempfile.mkdtemp(prefix='cfy-ap-', dir=workspace)
+    try:
+        build = Build(config, modules, venv, python, destination_tar,
+                      workdir, force=force, no_validate=no_validate,
+                      validation=validation, chunks=chunks,
+                      cache_entry=artifact_cache and (artifact_cache,
+                                                      fingerprint),
+                      checkpoint=checkpoint)
+        build_scheduler = Scheduler(build.stages(), jobs=get_option(
+            config.getint, 'build', 'jobs') or scheduler.DEFAULT_JOBS)
+        try:
+            build_scheduler.run(skip=build.completed_stages(),
+                                on_complete=build.on_complete)
+        except Exception:
+            if not stream:
+                _remove_outputs(destination_tar, chunks)
+            raise
+        finally:
+            if critical_path:
+                build_scheduler.log_critical_path()
+        if checkpoint:
+            checkpoint.remove()
+        history_file = get_option(config, 'build', 'history')
+        if timings_file or history_file:
+            venv_size = utils.get_size(venv)
+        if timings_file:
+            estimate.record_build(
+                timings_file, fingerprint, build_scheduler.timings,
+                venv_size, build.archive_size)
+        if history_file:
+            lgr.info('Recording the build in {0}'.format(history_file))
+            history.record_build(
+                history_file, fingerprint, build_scheduler.timings,
+                venv_size, build.archive_size,
+                utils.get_distributions(venv))
+
+        keep_virtualenv = get_option(
+            config.getboolean, 'output', 'keep_virtualenv') or False
+        if keep_virtualenv and workspace:
+            lgr.info('Moving virtualenv to {0}...'.format(DEFAULT_VENV_PATH))
+            if not os.path.isdir(os.path.dirname(DEFAULT_VENV_PATH)):
+                os.makedirs(os.path.dirname(DEFAULT_VENV_PATH))
+            shutil.move(venv, DEFAULT_VENV_PATH)
+        elif not keep_virtualenv and not venv_already_exists:
+            lgr.info('Removing origin virtualenv...')
+            shutil.rmtree(venv)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
 
     lgr.info('Process complete!')
@@ -0,0 +1,294 @@
+import logging
+import os
+import re
+from multiprocessing.pool import ThreadPool
+
+import pkg_resources
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    # py2
+    from urlparse import urljoin
+
+
+DEFAULT_JOBS = 16
+DEFAULT_TIMEOUT = 30
+VCS_PREFIXES = ('git+', 'hg+', 'svn+', 'bzr+')
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.zip', '.whl')
+PYPI_JSON_URL = 'https://pypi.org/pypi/{0}/json'
+# requirements file options including another requirements file
+INCLUDE_OPTIONS = ('-r', '--requirement', '-c', '--constraint')
+# a PEP 508 direct reference, e.g. `foo[bar] @ https://host/foo.tar.gz`
+DIRECT_REFERENCE = re.compile(
+    r'^[A-Za-z0-9][A-Za-z0-9._-]*\s*(\[[^\]]*\])?\s*@\s*(?P<url>\S+)')
+
+lgr = logging.getLogger()
+
+
+class Check(object):
+    """The result of checking a single source.
+
+    :param string source: the source, as given in the config.
+    :param string origin: where the source was specified, for reporting.
+    :param string kind: the kind of the source, see `classify`.
+    """
+    def __init__(self, source, origin, kind=None):
+        self.source = source
+        self.origin = origin
+        self.kind = kind or classify(source)
+        self.error = None
+        self.size = None
+        self.skipped = False
+
+    def __str__(self):
+        if self.error:
+            status = 'FAILED: {0}'.format(self.error)
+        elif self.skipped:
+            status = 'not checked'
+        else:
+            status = 'OK'
+        return '{0} ({1}): {2}'.format(self.source, self.origin, status)
+
+
+def get_url(source):
+    """returns the url a source is downloaded from: the url part of a
+    direct reference (`name @ url`), or the source itself
+    """
+    match = DIRECT_REFERENCE.match(source)
+    return match.group('url') if match else source
+
+
+def classify(source):
+    """returns the kind of a source: a url, a vcs url, a local path
+    or a requirement specifier
+
+    Direct references are of the kind of their url, unless it is neither
+    an http(s) nor a vcs url.
+    """
+    url = get_url(source)
+    if url.startswith(('http://', 'https://')):
+        return 'url'
+    if url.startswith(VCS_PREFIXES):
+        return 'vcs'
+    if url != source:
+        return 'requirement'
+    if os.path.exists(source) or source.startswith(('.', '/', '~')) or \
+            os.sep in source or source.endswith(ARCHIVE_SUFFIXES):
+        return 'path'
+    return 'requirement'
+
+
+def make_session(jobs=DEFAULT_JOBS):
+    """returns a requests session with a connection pool large enough
+    for `jobs` concurrent requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get_size(response):
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    if response.status_code == 200 and \
+            'Content-Length' in response.headers:
+        return int(response.headers['Content-Length'])
+    return None
+
+
+def check_url(session, url, timeout=DEFAULT_TIMEOUT):
+    """checks that a url is reachable, without downloading it
+
+    A HEAD request is tried first. Servers that don't support HEAD are
+    asked for the first byte of the resource instead.
+    :return: the size of the resource, if known
+    """
+    response = session.head(url, allow_redirects=True, timeout=timeout)
+    if response.status_code >= 400:
+        response = session.get(
+            url, headers={'Range': 'bytes=0-0'}, stream=True,
+            allow_redirects=True, timeout=timeout)
+        response.close()
+    if response.status_code >= 400:
+        raise ValueError('HTTP {0}'.format(response.status_code))
+    return _get_size(response)
+
+
+def get_requirement_size(session, requirement, timeout=DEFAULT_TIMEOUT):
+    """returns the download size of a requirement, according to PyPI
+
+    Pure python wheels are preferred, then source distributions. Only the
+    requirement itself is looked up, not its dependencies.
+    :param requirement: a parsed requirement.
+    :return: the size in bytes, or None if unknown
+    """
+    name = requirement.project_name
+    if len(requirement.specs) == 1 and requirement.specs[0][0] == '==':
+        name = '{0}/{1}'.format(name, requirement.specs[0][1])
+    response = session.get(PYPI_JSON_URL.format(name), timeout=timeout)
+    if response.status_code >= 400:
+        raise ValueError('HTTP {0}'.format(response.status_code))
+    files = response.json().get('urls', [])
+    for suffix in ('-none-any.whl', '.tar.gz', '.zip', '.whl'):
+        sizes = [f['size'] for f in files
+                 if f['filename'].endswith(suffix) and f.get('size')]
+        if sizes:
+            return min(sizes)
+    return None
+
+
+def _check(session, check, timeout=DEFAULT_TIMEOUT, sizes=False):
+    try:
+        if check.kind == 'url':
+            check.size = check_url(session, get_url(check.source), timeout)
+        elif check.kind == 'path':
+            path = os.path.expanduser(check.source)
+            if not os.path.exists(path):
+                raise ValueError('no such file or directory')
+            if os.path.isfile(path):
+                check.size = os.path.getsize(path)
+        elif check.kind == 'requirement':
+            requirement = pkg_resources.Requirement.parse(check.source)
+            if sizes:
+                try:
+                    check.size = get_requirement_size(
+                        session, requirement, timeout)
+                except Exception as e:
+                    # the requirement may be served by another index
+                    lgr.debug('Could not get the size of {0}: {1}'.format(
+                        check.source, e))
+        else:
+            check.skipped = True
+    except Exception as e:
+        check.error = str(e) or type(e).__name__
+    lgr.debug(str(check))
+    return check
+
+
+def read_requirements_file(session, source, timeout=DEFAULT_TIMEOUT):
+    """returns the contents of a local or remote requirements file
+    """
+    if classify(source) == 'url':
+        response = session.get(source, timeout=timeout)
+        if response.status_code >= 400:
+            raise ValueError('HTTP {0}'.format(response.status_code))
+        return response.text
+    with open(os.path.expanduser(source)) as f:
+        return f.read()
+
+
+def _resolve_source(source, path):
+    """returns a source given in a requirements file, and its kind, with
+    files resolved against the path or url of the requirements file
+    """
+    kind = classify(source)
+    if kind in ('url', 'vcs'):
+        return source, kind
+    # anything else given to these options is a file
+    if classify(path) == 'url':
+        return urljoin(path, source), 'url'
+    return os.path.join(os.path.dirname(path), source), 'path'
+
+
+def read_requirements_files(session, source, timeout=DEFAULT_TIMEOUT):
+    """returns the contents of a requirements file and of the files it
+    includes (-r and -c), recursively
+
+    :return: dict mapping the path or url of every file to its contents
+    """
+    contents = {}
+    pending = [source]
+    while pending:
+        path = pending.pop(0)
+        if path in contents:
+            continue
+        contents[path] = read_requirements_file(session, path, timeout)
+        for line in contents[path].splitlines():
+            option, _, value = line.split(' #', 1)[0].strip().partition(' ')
+            if option in INCLUDE_OPTIONS and value.strip():
+                pending.append(_resolve_source(value.strip(), path)[0])
+    return contents
+
+
+def parse_requirements(content, path):
+    """returns a list of checks for the lines of a requirements file
+
+    Options are ignored, except for those pointing at other sources
+    (-r, -c and -e), which are checked as well.
+    :param string content: the contents of the requirements file.
+    :param string path: the path or url of the requirements file, which
+     relative sources are resolved against.
+    """
+    checks = []
+    for number, line in enumerate(content.splitlines(), 1):
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        origin = '{0}:{1}'.format(path, number)
+        if not line.startswith('-'):
+            # drop per-requirement options, e.g. --hash
+            checks.append(Check(line.split(' --', 1)[0].strip(), origin))
+            continue
+        option, _, value = line.partition(' ')
+        if option not in INCLUDE_OPTIONS + ('-e', '--editable'):
+            continue
+        source, kind = _resolve_source(value.strip(), path)
+        checks.append(Check(source, origin, kind))
+    return checks
+
+
+def run(modules, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, sizes=False):
+    """checks all sources of the modules to install concurrently
+
+    :param dict modules: dict containing core and additional
+    modules and the cloudify-agent module.
+    :param int jobs: the number of checks to run concurrently.
+    :param bool sizes: whether to also look up the download sizes of
+     requirements on PyPI (those of urls and paths are always known).
+    :return: a list of checks, in the order of installation
+    """
+    checks = []
+    requirements_file = modules.get('requirements_file')
+    for name in modules['additional_modules']:
+        checks.append(Check(name, 'additional_modules'))
+    for name, source in modules['additional_plugins'].items():
+        checks.append(Check(source, 'additional_plugins: {0}'.format(name)))
+    checks.append(Check(modules['agent'], 'cloudify_agent_module'))
+
+    session = make_session(jobs)
+
+    def _run_check(check):
+        return _check(session, check, timeout, sizes)
+
+    pool = ThreadPool(jobs)
+    try:
+        if requirements_file:
+            pending = pool.apply_async(
+                read_requirements_file,
+                (session, requirements_file, timeout))
+        pool.map(_run_check, checks)
+
+        if requirements_file:
+            requirements_check = Check(requirements_file,
+                                       'requirements_file')
+            try:
+                content = pending.get()
+            except Exception as e:
+                requirements_check.error = str(e) or type(e).__name__
+                checks.insert(0, requirements_check)
+            else:
+                requirements_check.size = len(content)
+                requirements = parse_requirements(content, requirements_file)
+                pool.map(_run_check, requirements)
+                checks[0:0] = [requirements_check] + requirements
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+    return checks
@@ -0,0 +1,198 @@
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    # py2
+    import Queue as queue
+
+from . import exceptions
+
+
+DEFAULT_JOBS = 4
+
+lgr = logging.getLogger()
+
+
+class Stage(object):
+    """A step of the build.
+
+    A stage runs once all of its inputs are available, i.e. once the
+    stages providing them have completed. Its function is called without
+    arguments, and may return a dict of the values of its outputs. Outputs
+    it doesn't return are set to None, so outputs can also be used just to
+    order stages.
+
+    :param string name: the name of the stage.
+    :param func: the function running the stage.
+    :param list inputs: names of the values the stage requires.
+    :param list outputs: names of the values the stage provides.
+    """
+    def __init__(self, name, func, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def __repr__(self):
+        return 'Stage({0})'.format(self.name)
+
+
+class Scheduler(object):
+    """Runs stages concurrently, each as soon as its inputs are available.
+
+    :param list stages: the stages to run.
+    :param list initial: names of the values available before any stage
+     runs.
+    :param int jobs: the maximum number of stages to run concurrently.
+    """
+    def __init__(self, stages, initial=(), jobs=DEFAULT_JOBS):
+        self.stages = list(stages)
+        self.jobs = jobs
+        # maps the name of a stage to its start and end times,
+        # relative to the start of the run
+        self.timings = {}
+        self._producers = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in self._producers or output in initial:
+                    raise exceptions.AgentPackagerError(
+                        '{0} is provided by more than one stage'.format(
+                            output))
+                self._producers[output] = stage
+        for stage in self.stages:
+            for name in stage.inputs:
+                if name not in self._producers and name not in initial:
+                    raise exceptions.AgentPackagerError(
+                        '{0} requires {1}, which no stage provides'.format(
+                            stage.name, name))
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting, visited = set(), set()
+
+        def visit(stage):
+            if stage.name in visited:
+                return
+            if stage.name in visiting:
+                raise exceptions.AgentPackagerError(
+                    'Stage {0} depends on itself'.format(stage.name))
+            visiting.add(stage.name)
+            for dependency in self.dependencies(stage):
+                visit(dependency)
+            visiting.discard(stage.name)
+            visited.add(stage.name)
+        for stage in self.stages:
+            visit(stage)
+
+    def dependencies(self, stage):
+        """returns the stages providing the inputs of a stage
+        """
+        return [self._producers[name] for name in stage.inputs
+                if name in self._producers]
+
+    def run(self, values=None, skip=(), on_complete=None):
+        """runs all stages, and returns all values
+
+        If a stage fails, no further stages are started, and once the
+        running ones end, the first error is raised.
+        :param dict values: the values available before any stage runs.
+        :param list skip: names of stages which are not run, e.g. as they
+         were completed by a previous run. Their outputs are set to None
+         once their inputs are available, so stages depending on them still
+         wait for the stages they depend on.
+        :param on_complete: called with every stage that completes.
+        """
+        values = dict(values or {})
+        pending = list(self.stages)
+        completed = queue.Queue()
+        running = set()
+        errors = []
+        start = time.time()
+
+        def _run_stage(stage):
+            stage_start = time.time() - start
+            lgr.debug('Starting stage {0}'.format(stage.name))
+            try:
+                result = stage.func() or {}
+            except BaseException as e:
+                completed.put((stage, None, e, stage_start))
+            else:
+                completed.put((stage, result, None, stage_start))
+
+        pool = ThreadPool(self.jobs)
+        try:
+            while pending or running:
+                ready = not errors
+                while ready:
+                    ready = [stage for stage in pending if all(
+                        name in values for name in stage.inputs)]
+                    for stage in ready:
+                        pending.remove(stage)
+                        if stage.name in skip:
+                            lgr.debug('Skipping stage {0}'.format(stage.name))
+                            for name in stage.outputs:
+                                values.setdefault(name, None)
+                            continue
+                        running.add(stage.name)
+                        pool.apply_async(_run_stage, (stage,))
+                if not running:
+                    break
+                stage, result, error, stage_start = completed.get()
+                running.discard(stage.name)
+                self.timings[stage.name] = (stage_start, time.time() - start)
+                if error:
+                    lgr.error('Stage {0} failed: {1}'.format(
+                        stage.name, error))
+                    errors.append(error)
+                    continue
+                lgr.debug('Stage {0} took {1:.2f}s'.format(
+                    stage.name, self.duration(stage.name)))
+                for name in stage.outputs:
+                    values[name] = result.get(name)
+                if on_complete:
+                    on_complete(stage)
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+        return values
+
+    def duration(self, name):
+        start, end = self.timings[name]
+        return end - start
+
+    def critical_path(self):
+        """returns the chain of stages which determined the length of the
+        last run, as a list of stage names
+
+        Starting from the stage which ended last, every stage is preceded
+        by the dependency which ended last, i.e. the one it waited for.
+        """
+        timed = [stage for stage in self.stages
+                 if stage.name in self.timings]
+        if not timed:
+            return []
+        stage = max(timed, key=lambda s: self.timings[s.name][1])
+        path = [stage.name]
+        while True:
+            dependencies = [dependency for dependency
+                            in self.dependencies(stage)
+                            if dependency.name in self.timings]
+            if not dependencies:
+                break
+            stage = max(dependencies,
+                        key=lambda s: self.timings[s.name][1])
+            path.append(stage.name)
+        return list(reversed(path))
+
+    def log_critical_path(self):
+        path = self.critical_path()
+        lgr.info('Critical path:\n{0}'.format('\n'.join(
+            '{0}: {1:.2f}s'.format(name, self.duration(name))
+            for name in path)))
+        if path:
+            lgr.info('Total: {0:.2f}s'.format(self.timings[path[-1]][1]))
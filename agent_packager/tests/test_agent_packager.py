@@ -16,15 +16,33 @@
 import agent_packager.packager as ap
 import agent_packager.cli as cli
 import agent_packager.utils as utils
-from agent_packager import exceptions
+from agent_packager import (cache, estimate, exceptions, extractor,
+                            history, installers, preflight, venv_helper)
+from agent_packager.checkpoint import Checkpoint
+from agent_packager.scheduler import Scheduler, Stage
 from requests import ConnectionError
 
 import errno
+import glob
+import hashlib
+import io
+import json
 import pytest
 import logging
 import tarfile
 import os
 import shutil
+import sys
+import threading
+import time
+import zipfile
+from distutils.spawn import find_executable
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    # py2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 
 TEST_RESOURCES_DIR = 'agent_packager/tests/resources/'
@@ -46,10 +64,96 @@ class FakeArgs:
         self.force = False
         self.dryrun = False
         self.no_validation = False
+        self.validation = None
+        self.no_preflight = False
+        self.no_cache = False
+        self.critical_path = False
+        self.resume = False
+        self.output = None
         # Normally defaults to false, but we want the tests to be descriptive
         self.verbose = True
 
 
+class FileServerHandler(BaseHTTPRequestHandler):
+    """Serves the files of `self.server.root`, as a stand-in for
+    remote sources.
+    """
+    def _path(self):
+        return os.path.join(
+            self.server.root, self.path.split('?')[0].lstrip('/'))
+
+    def do_HEAD(self, body=False):
+        path = self._path()
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        if body:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_GET(self):
+        self.do_HEAD(body=True)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        body = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if not size:
+                self.rfile.readline()
+                return b''.join(body)
+            body.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_PUT(self):
+        path = self._path()
+        if self.headers.get('If-None-Match') == '*' and os.path.exists(path):
+            self.send_error(412)
+            return
+        body = self._read_body()
+        if self.server.put_errors:
+            self.send_error(self.server.put_errors.pop(0))
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.part', 'wb') as f:
+            f.write(body)
+        os.rename(path + '.part', path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    server = HTTPServer(('127.0.0.1', 0), FileServerHandler)
+    server.root = str(tmpdir)
+    # statuses to fail the next PUT requests with
+    server.put_errors = []
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _remove_archive(archive):
+    for path in (archive,) + utils.get_sidecar_paths(archive):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
 @pytest.fixture
 def venv():
     shutil.rmtree(TEST_VENV, ignore_errors=True)
@@ -126,6 +230,159 @@ def test_install_module_nonexisting_venv():
         utils.install_module(TEST_MODULE, 'BLAH!!')
 
 
+def _add_fake_distribution(venv, name, init_content, files=None,
+                           requires=()):
+    site_packages = glob.glob(
+        os.path.join(venv, 'lib', 'python*', 'site-packages'))[0]
+    files = dict(files or {})
+    files['{0}/__init__.py'.format(name)] = init_content
+    for path, content in files.items():
+        path = os.path.join(site_packages, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+    dist_info = '{0}-1.0.dist-info'.format(name)
+    os.makedirs(os.path.join(site_packages, dist_info))
+    files.update({
+        '{0}/METADATA'.format(dist_info):
+            'Metadata-Version: 2.1\nName: {0}\nVersion: 1.0\n'.format(name) +
+            ''.join('Requires-Dist: {0}\n'.format(r) for r in requires),
+        '{0}/top_level.txt'.format(dist_info): '{0}\n'.format(name),
+    })
+    for path in files:
+        if path.startswith(dist_info):
+            with open(os.path.join(site_packages, path), 'w') as f:
+                f.write(files[path])
+    with open(os.path.join(site_packages, dist_info, 'RECORD'), 'w') as f:
+        f.write(''.join('{0},,\n'.format(path) for path in sorted(files)))
+        f.write('{0}/RECORD,,\n'.format(dist_info))
+    return site_packages
+
+
+def test_check_imports(venv):
+    _add_fake_distribution(TEST_VENV, 'good_module', '')
+    _add_fake_distribution(
+        TEST_VENV, 'broken_module', 'raise ImportError("libmissing.so")')
+    results = utils.check_imports(
+        ['good-module', 'broken-module', 'missing-module'], TEST_VENV)
+    assert results['good-module']['error'] is None
+    assert results['good-module']['modules']['good_module']['error'] is None
+    assert 'libmissing.so' in \
+        results['broken-module']['modules']['broken_module']['error']
+    assert results['missing-module']['error'] == 'distribution not found'
+
+
+def test_top_level_without_metadata(tmpdir, monkeypatch):
+    # e.g. python 2 virtualenvs, where importlib.metadata is missing
+    import pkg_resources
+    monkeypatch.setattr(venv_helper, 'metadata', None)
+    dists = {}
+    for name, files in (
+            ('foo', ['foo/__init__.py', 'bar.py', '_speedups.so']),
+            ('empty', [])):
+        info_dir = tmpdir.join('{0}-1.0.dist-info'.format(name))
+        info_dir.join('METADATA').write(
+            'Metadata-Version: 2.1\nName: {0}\nVersion: 1.0\n'.format(name),
+            ensure=True)
+        info_dir.join('RECORD').write(''.join(
+            '{0},,\n'.format(path) for path in files +
+            ['{0}/RECORD'.format(info_dir.basename)]))
+        dists[name] = pkg_resources.Distribution.from_location(
+            str(tmpdir), info_dir.basename, pkg_resources.PathMetadata(
+                str(tmpdir), str(info_dir)))
+
+    def get_distribution(name):
+        if name not in dists:
+            raise pkg_resources.DistributionNotFound(name)
+        return dists[name]
+    monkeypatch.setattr(pkg_resources, 'get_distribution', get_distribution)
+    assert venv_helper.get_top_level('foo') == ['_speedups', 'bar', 'foo']
+    assert venv_helper.get_top_level('empty') == []
+    assert venv_helper.get_top_level('missing') is None
+    # a distribution without modules would pass the check without importing
+    # anything
+    assert venv_helper.check_imports(['empty'])['empty']['error'] == \
+        'no top level modules found'
+
+
+def test_validate_imports(venv):
+    _add_fake_distribution(TEST_VENV, 'good_module', '')
+    _add_fake_distribution(
+        TEST_VENV, 'broken_module', 'raise ImportError("libmissing.so")')
+    report_file = os.path.join(TEST_VENV, 'report.json')
+    ap._validate_imports({'modules': ['good-module'], 'plugins': []},
+                         TEST_VENV, report_file=report_file)
+    with open(report_file) as f:
+        assert 'good_module' in json.load(f)['good-module']['modules']
+    with pytest.raises(exceptions.ImportCheckError, match='broken-module'):
+        ap._validate_imports(
+            {'modules': ['good-module'], 'plugins': ['broken-module']},
+            TEST_VENV)
+    with pytest.raises(exceptions.ImportCheckError, match='budget'):
+        ap._validate_imports(
+            {'modules': ['good-module'], 'plugins': []}, TEST_VENV,
+            budget=0)
+
+
+def test_zip_site_packages(venv):
+    site_packages = _add_fake_distribution(
+        TEST_VENV, 'pure_module', 'from pure_module.sub import VALUE\n',
+        files={'pure_module/sub.py': 'VALUE = 1\n'})
+    _add_fake_distribution(
+        TEST_VENV, 'data_module', '', files={'data_module/data.json': '{}'})
+    _add_fake_distribution(
+        TEST_VENV, 'location_module', 'import os\nHERE = __file__\n')
+    _add_fake_distribution(
+        TEST_VENV, 'native_module', '', files={'native_module/ext.so': ''})
+    modules = {
+        'modules': ['pure-module', 'data-module', 'location-module'],
+        'plugins': []}
+
+    result = ap._zip_site_packages(modules, TEST_VENV)
+    assert result['zipped'] == ['pure_module-1.0.dist-info']
+    assert result['kept']['data_module-1.0.dist-info'].startswith(
+        'data file')
+    assert result['kept']['location_module-1.0.dist-info'].endswith(
+        'refers to its location')
+    assert result['kept']['native_module-1.0.dist-info'].startswith(
+        'native extension')
+    assert 'pip-' in ' '.join(result['kept'])
+    assert not os.path.exists(os.path.join(site_packages, 'pure_module'))
+    with zipfile.ZipFile(result['zip']) as zf:
+        assert 'pure_module/sub.pyc' in zf.namelist()
+    results = utils.check_imports(['pure-module'], TEST_VENV)
+    assert results['pure-module']['modules']['pure_module']['error'] is None
+
+
+def test_exclude(venv):
+    _add_fake_distribution(TEST_VENV, 'keeper', '', requires=['shared'])
+    _add_fake_distribution(TEST_VENV, 'shared', '')
+    _add_fake_distribution(TEST_VENV, 'tool_a', '', requires=['tool-b'])
+    _add_fake_distribution(TEST_VENV, 'tool_b', '', requires=['shared'])
+    _add_fake_distribution(
+        TEST_VENV, 'extra_user', '', requires=['keeper; extra == "x"'])
+    modules = {'modules': ['keeper'], 'plugins': []}
+
+    sizes = ap._exclude(
+        modules, TEST_VENV, ['tool*', 'shared', 'keeper', 'extra_user'])
+    assert sorted(sizes) == ['extra_user', 'tool_a', 'tool_b']
+    assert all(size > 0 for size in sizes.values())
+    installed = [dist['name'] for dist in utils.get_distributions(TEST_VENV)]
+    assert 'keeper' in installed
+    assert 'shared' in installed
+    assert 'tool_a' not in installed
+    assert 'tool_b' not in installed
+
+
+def test_merge_exclude_modules():
+    config = ap._import_config(CONFIG_FILE)
+    config.add_section('exclude_modules')
+    config.set('exclude_modules', 'pytest*')
+    modules = ap._merge_modules(ap._set_defaults(), config)
+    assert modules['exclude_modules'] == ['pytest*']
+
+
 def test_download_file():
     utils.download_file(TEST_FILE, 'file')
     assert os.path.isfile('file')
@@ -167,6 +424,958 @@ def test_tar_missing_source():
     os.remove('file')
 
 
+def test_tar_digests():
+    os.makedirs('dir/sub')
+    with open('dir/sub/content.file', 'wb') as f:
+        f.write(b'CONTENT')
+    os.symlink('sub/content.file', 'dir/link')
+    try:
+        digest, files = utils.tar('dir', 'tar.file')
+        with open('tar.file', 'rb') as f:
+            assert digest == hashlib.sha256(f.read()).hexdigest()
+        assert files == {
+            'dir/sub/content.file': hashlib.sha256(b'CONTENT').hexdigest()}
+        with tarfile.open('tar.file', 'r:gz') as tar:
+            assert tar.getmember('dir/link').issym()
+    finally:
+        shutil.rmtree('dir')
+        os.remove('tar.file')
+
+
+def test_verify_tar():
+    os.makedirs('dir')
+    with open('dir/content.file', 'w') as f:
+        f.write('CONTENT')
+    try:
+        digest, files = utils.tar('dir', 'tar.file')
+        checksum_file, manifest_file = utils.write_sidecars(
+            'tar.file', digest, files)
+        with open(checksum_file) as f:
+            assert f.read() == '{0}  tar.file\n'.format(digest)
+        utils.verify_tar('tar.file')
+    finally:
+        shutil.rmtree('dir')
+        _remove_archive('tar.file')
+
+
+def test_verify_tar_mismatch():
+    os.makedirs('dir')
+    with open('dir/content.file', 'w') as f:
+        f.write('CONTENT')
+    try:
+        digest, files = utils.tar('dir', 'tar.file')
+        files['dir/content.file'] = 'BAD'
+        files['dir/missing.file'] = 'BAD'
+        utils.write_sidecars('tar.file', digest, files)
+        with pytest.raises(exceptions.ArchiveVerificationError) as cm:
+            utils.verify_tar('tar.file')
+        assert 'dir/content.file: checksum mismatch' in str(cm.value)
+        assert 'dir/missing.file: missing from archive' in str(cm.value)
+    finally:
+        shutil.rmtree('dir')
+        _remove_archive('tar.file')
+
+
+def test_verify_tar_missing_manifest():
+    with pytest.raises(
+            exceptions.ArchiveVerificationError, match='No such file'):
+        utils.verify_tar('tar.file')
+
+
+def _write_sources(root):
+    with open(os.path.join(root, 'agent.tar.gz'), 'wb') as f:
+        f.write(b'AGENT')
+    with open(os.path.join(root, 'requirements.txt'), 'w') as f:
+        f.write('xmltodict==0.12.0 --hash=sha256:abc  # comment\n'
+                '-r nested.txt\n'
+                '--index-url https://pypi.example.com\n'
+                'bad spec ===\n')
+    with open(os.path.join(root, 'nested.txt'), 'w') as f:
+        f.write('requests\n')
+
+
+def test_preflight(http_server):
+    _write_sources(http_server.root)
+    modules = {
+        'requirements_file': http_server.url + '/requirements.txt',
+        'additional_modules': ['xmltodict'],
+        'additional_plugins': {
+            'plugin': http_server.url + '/missing.tar.gz',
+            'local-plugin': MOCK_MODULE,
+            'missing-plugin': 'nonexistent/plugin.tar.gz',
+            'vcs-plugin': 'git+https://example.com/plugin.git',
+        },
+        'agent': http_server.url + '/agent.tar.gz',
+    }
+    checks = dict((check.source, check) for check in preflight.run(modules))
+    assert checks[http_server.url + '/agent.tar.gz'].size == 5
+    assert checks[http_server.url + '/nested.txt'].error is None
+    assert checks['xmltodict==0.12.0'].error is None
+    assert checks['bad spec ==='].error is not None
+    assert checks[http_server.url + '/missing.tar.gz'].error == 'HTTP 404'
+    assert checks[MOCK_MODULE].error is None
+    assert checks['nonexistent/plugin.tar.gz'].error is not None
+    assert checks['git+https://example.com/plugin.git'].skipped
+
+    with pytest.raises(exceptions.PreflightError) as cm:
+        ap._preflight(modules)
+    assert '3 of 10 sources are unavailable' in str(cm.value)
+    assert 'missing.tar.gz (additional_plugins: plugin)' in str(cm.value)
+
+
+def test_direct_references(http_server):
+    _write_sources(http_server.root)
+    assert preflight.classify('foo @ https://example.com/foo-1.0.tar.gz') \
+        == 'url'
+    assert preflight.classify('foo[bar]@ git+https://example.com/foo') \
+        == 'vcs'
+    assert preflight.classify('foo @ file:///tmp/foo-1.0.tar.gz') == \
+        'requirement'
+    assert preflight.classify('dir/foo@1.0.tar.gz') == 'path'
+    assert preflight.get_url('foo @ https://example.com/foo.zip ; '
+                             'python_version < "3"') == \
+        'https://example.com/foo.zip'
+
+    session = preflight.make_session()
+    found, missing = [
+        preflight._check(session, preflight.Check(
+            'agent @ {0}/{1}'.format(http_server.url, name), 'test'))
+        for name in ('agent.tar.gz', 'missing.tar.gz')]
+    assert (found.error, found.size) == (None, 5)
+    assert missing.error == 'HTTP 404'
+
+
+def test_requirement_size(http_server, monkeypatch):
+    monkeypatch.setattr(preflight, 'PYPI_JSON_URL',
+                        http_server.url + '/pypi/{0}/json')
+    for path, files in (
+            ('xmltodict/json', [('xmltodict-1.0.tar.gz', 300),
+                                ('xmltodict-1.0-py3-none-any.whl', 200)]),
+            ('six/1.0/json', [('six-1.0.tar.gz', 100)])):
+        path = os.path.join(http_server.root, 'pypi', path)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump({'urls': [{'filename': name, 'size': size}
+                                for name, size in files]}, f)
+    checks = [preflight.Check(source, 'test') for source in
+              ('xmltodict>=0.9', 'six==1.0', 'missing')]
+    session = preflight.make_session()
+    for check in checks:
+        preflight._check(session, check, sizes=True)
+    assert [check.size for check in checks] == [200, 100, None]
+    assert not any(check.error for check in checks)
+
+
+def test_check(http_server):
+    _write_sources(http_server.root)
+    config = ap._import_config(CONFIG_FILE)
+    config.set('install', 'requirements_file',
+               http_server.url + '/nested.txt')
+    config.set('install', 'cloudify_agent_module',
+               http_server.url + '/agent.tar.gz')
+    ap.check(config)
+
+    config.set('install', 'requirements_file',
+               http_server.url + '/missing.txt')
+    with pytest.raises(exceptions.PreflightError, match='HTTP 404'):
+        ap.check(config)
+
+
+def _make_archive(archive):
+    os.makedirs('dir')
+    with open('dir/content.file', 'w') as f:
+        f.write('CONTENT')
+    try:
+        digest, files = utils.tar('dir', archive)
+        utils.write_sidecars(archive, digest, files)
+    finally:
+        shutil.rmtree('dir')
+    return digest
+
+
+def _check_cache(artifact_cache):
+    digest = _make_archive('tar.file')
+    try:
+        assert not cache.fetch(artifact_cache, 'key', 'out.tar.gz')
+        assert not artifact_cache.contains('key')
+        cache.publish(artifact_cache, 'key', 'tar.file')
+        assert artifact_cache.contains('key')
+        # publishing an existing key is a no-op
+        cache.publish(artifact_cache, 'key', 'tar.file')
+        assert cache.fetch(artifact_cache, 'key', 'out.tar.gz')
+        with open('out.tar.gz.sha256') as f:
+            assert f.read() == '{0}  out.tar.gz\n'.format(digest)
+        utils.verify_tar('out.tar.gz')
+    finally:
+        _remove_archive('tar.file')
+        _remove_archive('out.tar.gz')
+
+
+def test_filesystem_cache(tmpdir):
+    _check_cache(cache.get_cache(str(tmpdir.join('cache'))))
+
+
+def test_filesystem_cache_concurrent_publish(tmpdir):
+    artifact_cache = cache.FilesystemCache(str(tmpdir))
+    _make_archive('tar.file')
+    try:
+        threads = [
+            threading.Thread(target=artifact_cache.publish,
+                             args=('key', 'tar.file'))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert os.listdir(str(tmpdir)) == ['key']
+        assert sorted(os.listdir(str(tmpdir.join('key')))) == [
+            cache.ARCHIVE_NAME, cache.MANIFEST_NAME]
+    finally:
+        _remove_archive('tar.file')
+
+
+def test_http_cache(http_server):
+    _check_cache(cache.get_cache(http_server.url + '/cache'))
+
+    # an entry whose publisher failed before uploading the manifest
+    artifact_cache = cache.get_cache(http_server.url + '/cache')
+    os.makedirs(os.path.join(http_server.root, 'cache', 'partial'))
+    with open(os.path.join(http_server.root, 'cache', 'partial',
+                           cache.ARCHIVE_NAME), 'w') as f:
+        f.write('PARTIAL')
+    _make_archive('tar.file')
+    try:
+        cache.publish(artifact_cache, 'partial', 'tar.file')
+        assert cache.fetch(artifact_cache, 'partial', 'out.tar.gz')
+    finally:
+        _remove_archive('tar.file')
+        _remove_archive('out.tar.gz')
+
+
+def test_cache_fetch_corrupted(tmpdir):
+    artifact_cache = cache.FilesystemCache(str(tmpdir))
+    _make_archive('tar.file')
+    try:
+        artifact_cache.publish('key', 'tar.file')
+        with open(str(tmpdir.join('key', cache.ARCHIVE_NAME)), 'ab') as f:
+            f.write(b'GARBAGE')
+        assert not cache.fetch(artifact_cache, 'key', 'out.tar.gz')
+        assert not os.path.exists('out.tar.gz')
+        assert not os.path.exists('out.tar.gz.manifest.json')
+    finally:
+        _remove_archive('tar.file')
+
+
+def test_fingerprint():
+    config = ap._import_config(CONFIG_FILE)
+    modules = ap._merge_modules(ap._set_defaults(), config)
+    name_params = {'distro': 'Ubuntu', 'release': 'trusty'}
+    key = ap._fingerprint(config, modules, name_params, None)
+    config.set('output', 'tar', 'other.tar.gz')
+    assert ap._fingerprint(config, modules, name_params, None) == key
+    modules['additional_modules'].append(TEST_MODULE)
+    assert ap._fingerprint(config, modules, name_params, None) != key
+
+
+def test_fingerprint_requirements(tmpdir):
+    requirements_file = tmpdir.join('requirements.txt')
+    requirements_file.write('-r nested.txt\nsix==1.16.0\n')
+    tmpdir.join('nested.txt').write('xmltodict==0.10\n')
+    modules = {'requirements_file': str(requirements_file),
+               'additional_modules': [], 'additional_plugins': {},
+               'agent': '/tmp/agent.tar.gz'}
+    requirements = ap._read_requirements(modules)
+    assert sorted(requirements) == [
+        str(tmpdir.join('nested.txt')), str(requirements_file)]
+    config = ap._import_config(CONFIG_FILE)
+    name_params = {'distro': 'Ubuntu', 'release': 'trusty'}
+    key = ap._fingerprint(config, modules, name_params, None, requirements)
+    assert ap._is_cacheable(modules, requirements)
+
+    # the contents of included files are part of the fingerprint
+    tmpdir.join('nested.txt').write('xmltodict==0.11\n')
+    assert ap._fingerprint(config, modules, name_params, None,
+                           ap._read_requirements(modules)) != key
+
+    tmpdir.join('nested.txt').write(
+        'git+https://github.com/org/repo@1.0#egg=repo\n'
+        'git+https://github.com/org/other#egg=other\n')
+    modules['additional_plugins']['plugin'] = \
+        'https://github.com/org/plugin/archive/master.zip?x=1'
+    requirements = ap._read_requirements(modules)
+    assert ap._moving_sources(modules, requirements) == [
+        'git+https://github.com/org/other#egg=other',
+        'https://github.com/org/plugin/archive/master.zip?x=1']
+    assert not ap._is_cacheable(modules, requirements)
+    assert not ap._is_cacheable(modules, None)
+
+    # unpinned requirements may resolve to other versions, unless another
+    # line (e.g. of a constraints file) pins them
+    tmpdir.join('nested.txt').write(
+        'requests>=2.9.1\nxmltodict\n-c constraints.txt\n'
+        'foo @ https://example.com/foo-1.0.tar.gz\npbr==5.*\n')
+    tmpdir.join('constraints.txt').write('xmltodict===0.12.0\n')
+    modules['additional_plugins'] = {}
+    modules['additional_modules'] = ['six']
+    assert ap._moving_sources(
+        modules, ap._read_requirements(modules)) == [
+            'pbr==5.*', 'requests>=2.9.1']
+
+
+def test_tar_chunks(tmpdir):
+    os.makedirs('dir/sub')
+    sizes = [5000, 4000, 3000, 2000, 1000, 1000]
+    for i, size in enumerate(sizes):
+        with open('dir/sub/file{0}'.format(i), 'wb') as f:
+            f.write(os.urandom(size))
+    os.symlink('sub/file0', 'dir/link')
+    try:
+        index_path = utils.tar_chunks('dir', 'tar.tar.gz', 2)
+        assert index_path == 'tar.index.json'
+        with open(index_path) as f:
+            index = json.load(f)
+        assert [chunk['name'] for chunk in index['chunks']] == [
+            'tar.part000.tar.gz', 'tar.part001.tar.gz']
+        assert sorted(chunk['bytes'] for chunk in index['chunks']) == [
+            8000, 8000]
+        assert len(index['files']) == len(sizes)
+
+        extractor.extract(index_path, str(tmpdir), jobs=2)
+        for i in range(len(sizes)):
+            with open('dir/sub/file{0}'.format(i), 'rb') as original:
+                with open(str(tmpdir.join('dir/sub/file{0}'.format(i))),
+                          'rb') as extracted:
+                    assert original.read() == extracted.read()
+        assert os.readlink(str(tmpdir.join('dir/link'))) == 'sub/file0'
+    finally:
+        shutil.rmtree('dir')
+        for path in glob.glob('tar.*'):
+            os.remove(path)
+
+
+def test_extract_chunks_shared_directories(tmpdir):
+    # files of every chunk share parent directories, which the chunks
+    # mustn't race to create
+    source = tmpdir.join('source')
+    for i in range(400):
+        source.join('dir{0}'.format(i % 50), 'a', 'b', 'c').ensure(
+            'file{0}'.format(i), file=True).write('x' * (i + 1))
+    index_path = utils.tar_chunks(
+        str(source), str(tmpdir.join('tar.tar.gz')), 8, arcname='dir')
+    for attempt in range(10):
+        out = tmpdir.join('out{0}'.format(attempt))
+        extractor.extract(index_path, str(out), jobs=8)
+        assert len(out.join('dir').listdir()) == 50
+        assert out.join('dir', 'dir49', 'a', 'b', 'c', 'file399').read() \
+            == 'x' * 400
+
+
+def test_extract_chunks_over_http(http_server, tmpdir):
+    os.makedirs('dir')
+    for i in range(4):
+        with open('dir/file{0}'.format(i), 'wb') as f:
+            f.write(os.urandom(1000))
+    try:
+        utils.tar_chunks(
+            'dir', os.path.join(http_server.root, 'tar.tar.gz'), 3)
+        extractor.extract(http_server.url + '/tar.index.json',
+                          str(tmpdir.join('out')))
+        assert sorted(os.listdir(str(tmpdir.join('out', 'dir')))) == [
+            'file0', 'file1', 'file2', 'file3']
+
+        with open(os.path.join(http_server.root, 'tar.part001.tar.gz'),
+                  'ab') as f:
+            f.write(b'GARBAGE')
+        with pytest.raises(RuntimeError, match='checksum mismatch'):
+            extractor.extract(http_server.url + '/tar.index.json',
+                              str(tmpdir.join('out2')))
+    finally:
+        shutil.rmtree('dir')
+
+
+def test_estimate_venv_size():
+    checks = [preflight.Check('requirements.txt', 'requirements_file'),
+              preflight.Check('xmltodict', 'additional_modules'),
+              preflight.Check('agent.tar.gz', 'cloudify_agent_module')]
+    checks[0].size = 10
+    checks[2].size = 1000
+    assert ap._estimate_venv_size(checks) == (
+        ap.BASE_VENV_SIZE + ap.UNKNOWN_SOURCE_SIZE +
+        1000 * ap.SOURCE_EXPANSION)
+
+
+def test_make_workspace(tmpdir):
+    config = ap._import_config(CONFIG_FILE)
+    assert ap._make_workspace(config, None) is None
+
+    config.add_section('build')
+    config.set('build', 'memory_path', str(tmpdir))
+    config.set('build', 'workspace', 'memory')
+    workspace = ap._make_workspace(config, None)
+    assert os.path.dirname(workspace) == str(tmpdir)
+
+    config.set('build', 'workspace', 'auto')
+    config.set('build', 'size_estimate', str(1024 ** 3))
+    assert ap._make_workspace(config, None) is None
+    config.set('build', 'size_estimate', '1')
+    assert ap._make_workspace(config, None) is not None
+
+    # without a preflight check or recorded builds, the size is unknown
+    config.remove_option('build', 'size_estimate')
+    assert ap._make_workspace(config, None) is None
+    assert ap._make_workspace(config, []) is not None
+    config.set('build', 'timings', str(tmpdir.join('timings.jsonl')))
+    estimate.record_build(config.get('build', 'timings'), 'key',
+                          {'install': (0, 1)}, 1024 ** 4, 1)
+    assert ap._make_workspace(config, None, 'other') is None
+    assert ap._make_workspace(config, [], 'key') is None
+
+    config.set('build', 'memory_path', str(tmpdir.join('missing')))
+    assert ap._make_workspace(config, None) is None
+    config.set('build', 'workspace', 'memory')
+    with pytest.raises(exceptions.ConfigFileError, match='No such dir'):
+        ap._make_workspace(config, None)
+    config.set('build', 'workspace', 'tape')
+    with pytest.raises(exceptions.ConfigFileError, match='Unknown'):
+        ap._make_workspace(config, None)
+
+
+def test_upload_tar(http_server, tmpdir):
+    source = tmpdir.join('env')
+    source.join('content.file').write('CONTENT', ensure=True)
+    url = http_server.url + '/packages/agent.tar.gz'
+    # the archive is streamed again after a server error
+    http_server.put_errors = [503]
+    digest, files = utils.upload_tar(str(source), url, arcname='env')
+    assert list(files) == ['env/content.file']
+    utils.upload_sidecars(url, digest, files)
+    utils.verify_tar(os.path.join(http_server.root, 'packages',
+                                  'agent.tar.gz'))
+
+    http_server.put_errors = [403, 503]
+    with pytest.raises(exceptions.UploadError, match='403'):
+        utils.upload_tar(str(source), url)
+    # client errors are not retried
+    assert http_server.put_errors == [503]
+
+
+def test_archive_to_stdout(tmpdir, monkeypatch):
+    source = tmpdir.join('env')
+    source.join('content.file').write('CONTENT', ensure=True)
+
+    class FakeStdout(object):
+        buffer = io.BytesIO()
+    monkeypatch.setattr(sys, 'stdout', FakeStdout)
+    config = ap._import_config(CONFIG_FILE)
+    build = ap.Build(config, ap._set_defaults(), str(source), None, '-', '.')
+    build.archive()
+    FakeStdout.buffer.seek(0)
+    with tarfile.open(fileobj=FakeStdout.buffer, mode='r:gz') as tar:
+        assert tar.getnames() == [
+            ap.DEFAULT_VENV_PATH, ap.DEFAULT_VENV_PATH + '/content.file']
+
+
+def test_tar_arcname(tmpdir):
+    source = tmpdir.join('workspace', 'env')
+    source.join('content.file').write('CONTENT', ensure=True)
+    try:
+        _, files = utils.tar(str(source), 'tar.file', arcname='cloudify/env')
+        assert list(files) == ['cloudify/env/content.file']
+        with tarfile.open('tar.file', 'r:gz') as tar:
+            assert tar.getnames() == [
+                'cloudify/env', 'cloudify/env/content.file']
+    finally:
+        os.remove('tar.file')
+
+
+@pytest.mark.skipif(not all(find_executable(tool) for tool in (
+    'gcc', 'strip', 'objcopy')), reason='requires gcc and binutils')
+def test_strip_debug_symbols(tmpdir):
+    venv = tmpdir.join('env')
+    source = tmpdir.join('ext.c')
+    source.write('int answer(void) { return 42; }\n')
+    shared_object = venv.join('lib', 'ext.so')
+    shared_object.dirpath().ensure(dir=True)
+    assert utils.run('gcc -g -shared -fPIC -o {0} {1}'.format(
+        shared_object, source)).returncode == 0
+    venv.join('lib', 'fake.so').write('not an ELF file')
+    os.symlink(str(shared_object), str(venv.join('lib', 'ext.so.1')))
+    assert utils.find_shared_objects(str(venv)) == [str(shared_object)]
+
+    size = shared_object.size()
+    debug_dir = tmpdir.join('debug')
+    saved = ap._strip_debug_symbols(str(venv), str(debug_dir))
+    assert saved > 0
+    assert shared_object.size() == size - saved
+    assert debug_dir.join('lib', 'ext.so.debug').check(file=True)
+    assert b'.gnu_debuglink' in shared_object.read_binary()
+    # already stripped
+    assert ap._strip_debug_symbols(str(venv)) == 0
+
+
+def test_predict_from_recorded_builds(tmpdir):
+    timings_file = str(tmpdir.join('timings.jsonl'))
+    assert estimate.predict(estimate.load_builds(timings_file))[
+        'duration'] is None
+    estimate.record_build(timings_file, 'other', {'install': (0, 50)},
+                          1000, 500)
+    for duration in (10, 30, 20):
+        estimate.record_build(
+            timings_file, 'key',
+            {'make_venv': (0, 2), 'install': (2, duration)}, 1000, 200)
+
+    prediction = estimate.predict(estimate.load_builds(timings_file), 'key')
+    assert prediction['builds'] == 3
+    assert prediction['matching']
+    assert prediction['duration'] == 20
+    assert prediction['stages'] == {'make_venv': 2, 'install': 18}
+    assert prediction['venv_size'] == 1000
+    assert prediction['archive_ratio'] == 0.2
+
+    prediction = estimate.predict(estimate.load_builds(timings_file), 'new')
+    assert prediction['builds'] == 4
+    assert not prediction['matching']
+    assert prediction['duration'] == 25
+    assert prediction['venv_size'] is None
+
+
+def test_estimate(tmpdir):
+    agent = tmpdir.join('agent.tar.gz')
+    agent.write('AGENT')
+    modules = {'requirements_file': None, 'additional_modules': [],
+               'additional_plugins': {}, 'agent': str(agent)}
+    config = ap._import_config(CONFIG_FILE)
+    config.add_section('build')
+    config.set('build', 'timings', str(tmpdir.join('timings.jsonl')))
+    artifact_cache = cache.FilesystemCache(str(tmpdir.join('cache')))
+
+    result = ap._estimate(config, modules, 'key', artifact_cache)
+    assert result['sources'][0]['kind'] == 'path'
+    assert result['download_size'] == 0
+    assert not result['cached']
+    assert result['venv_size'] == \
+        ap.BASE_VENV_SIZE + len('AGENT') * ap.SOURCE_EXPANSION
+    assert result['duration'] is None
+
+    estimate.record_build(config.get('build', 'timings'), 'key',
+                          {'install': (0, 60)}, 1000, 100)
+    tmpdir.join('cache', 'key', cache.ARCHIVE_NAME).write('', ensure=True)
+    result = ap._estimate(config, modules, 'key', artifact_cache)
+    assert result['cached']
+    assert result['venv_size'] == 1000
+    assert result['archive_size'] == 100
+    assert result['duration'] == 60
+
+
+def test_cached_sources(tmpdir, monkeypatch):
+    wheelhouse = tmpdir.mkdir('wheelhouse')
+    _make_wheel(wheelhouse, 'foo', '1.0')
+    checks = [preflight.Check(source, 'test') for source in (
+        'foo>=1', 'foo>1', 'http://host/foo-1.0-py2.py3-none-any.whl',
+        'xmltodict', 'http://host/plugin.tar.gz')]
+    config = ap._import_config(CONFIG_FILE)
+    config.set('install', 'wheelhouse', str(wheelhouse))
+    # the wheelhouse is only used by the wheel installer
+    assert ap._get_cached_sources(config, 'key', checks) == {}
+
+    config.set('install', 'installer', 'wheel')
+    monkeypatch.setattr(ap, 'CHECKPOINT_FILE', str(tmpdir.join('cp.json')))
+    checkpoint = Checkpoint(ap.CHECKPOINT_FILE, 'key')
+    checkpoint.install('http://host/plugin.tar.gz')
+    assert ap._get_cached_sources(config, 'key', checks, resume=True) == {
+        'foo>=1': 'wheelhouse',
+        'http://host/foo-1.0-py2.py3-none-any.whl': 'wheelhouse',
+        'http://host/plugin.tar.gz': 'checkpoint',
+    }
+    assert 'http://host/plugin.tar.gz' not in ap._get_cached_sources(
+        config, 'key', checks)
+
+
+def _record_history(path, duration, archive_size, installed=(),
+                    fingerprint='key'):
+    return history.record_build(
+        path, fingerprint, {'make_venv': (0, 2), 'install': (2, duration)},
+        archive_size * 3, archive_size, installed)
+
+
+def test_history(tmpdir):
+    path = str(tmpdir.join('history.db'))
+    assert history.load_builds(path) == []
+    for duration in (10, 11, 12, 10):
+        _record_history(path, duration, 1000,
+                        [{'name': 'six', 'version': '1.0', 'size': 2 ** 20}])
+    build_id = _record_history(path, 30, 2000, [
+        {'name': 'six', 'version': '1.1', 'size': 2 ** 21},
+        {'name': 'big', 'version': '2.0', 'size': 80 * 2 ** 20}])
+
+    builds = history.load_builds(path, 'key', limit=3, packages=True)
+    assert [build['duration'] for build in builds] == [12, 10, 30]
+    assert builds[-1]['id'] == build_id
+    assert builds[-1]['stages'] == {'make_venv': 2, 'install': 28}
+    assert builds[-1]['installed']['big'] == {
+        'version': '2.0', 'size': 80 * 2 ** 20}
+    assert history.load_builds(path, 'other') == []
+    assert estimate.predict(history.load_builds(path), 'key')[
+        'archive_ratio'] == 1 / 3.0
+
+    results = history.check(history.load_builds(path, packages=True))
+    # too few builds to compare to
+    assert not any(result['regressions'] for result in results[:3])
+    assert not results[3]['regressions']
+    assert len(results[4]['regressions']) == 3
+    assert results[4]['increases']['archive_size'] == 100
+    assert not history.check(history.load_builds(path), thresholds={
+        'duration': 500, 'archive_size': 500, 'stage': 500})[4]['regressions']
+    assert history.package_changes(builds[-1], builds[-2]) == [
+        'big 2.0 was added (80.0MB)', 'six grew by 1.0MB (1.0 -> 1.1)']
+
+    # builds are only compared to builds of the same config
+    for _ in range(3):
+        _record_history(path, 3, 10, fingerprint='other')
+    _record_history(path, 12, 1000)
+    results = history.check(history.load_builds(path))
+    assert results[5]['increases']['duration'] is None
+    assert not results[7]['regressions']
+    assert not results[8]['regressions']
+    assert [build['fingerprint'] for build in history.load_builds(
+        path, 'ot')] == ['other'] * 3
+
+
+def test_history_command(tmpdir, monkeypatch):
+    path = str(tmpdir.join('history.db'))
+    for duration in (10, 11, 12):
+        _record_history(path, duration, 1000)
+    _record_history(path, 11, 1050)
+    parser = cli._history_parser()
+    cli._history(parser.parse_args(['--file', path]))
+
+    _record_history(path, 11, 5000)
+    with pytest.raises(SystemExit):
+        cli._history(parser.parse_args(['--file', path]))
+    cli._history(parser.parse_args(
+        ['--file', path, '--max-size-increase', '1000']))
+    with pytest.raises(exceptions.ConfigFileError):
+        cli._history(parser.parse_args(['--file', str(tmpdir.join('no'))]))
+
+    # the builds of a config are found by its fingerprint
+    config_file = tmpdir.join('config.ini')
+    config_file.write('[system]\ndistribution=Ubuntu\nrelease=trusty\n'
+                      '[install]\ncloudify_agent_module=/tmp/agent\n'
+                      '[build]\nhistory={0}\n'.format(path))
+    fingerprint = ap._get_fingerprint(ap._import_config(str(config_file)))
+    for duration in (10, 11, 12, 11):
+        _record_history(path, duration, 1000, fingerprint=fingerprint)
+    cli._history(parser.parse_args(['-c', str(config_file)]))
+    with pytest.raises(SystemExit):
+        cli._history(parser.parse_args(
+            ['-c', str(config_file), '--fingerprint', 'ke']))
+
+
+def test_scheduler_runs_independent_stages_concurrently():
+    events = []
+
+    def _stage(name, delay=0, result=None):
+        def _run():
+            events.append(('start', name))
+            time.sleep(delay)
+            events.append(('end', name))
+            return result
+        return _run
+
+    stages = [
+        Stage('slow', _stage('slow', 0.2, {'a': 1}), outputs=['a']),
+        Stage('fast', _stage('fast', 0.05, {'b': 2}), outputs=['b']),
+        Stage('join', _stage('join'), ['a', 'b'], ['c']),
+    ]
+    build_scheduler = Scheduler(stages, jobs=2)
+    values = build_scheduler.run()
+    assert values == {'a': 1, 'b': 2, 'c': None}
+    assert sorted(events[:2]) == [('start', 'fast'), ('start', 'slow')]
+    assert events[-2:] == [('start', 'join'), ('end', 'join')]
+    assert build_scheduler.timings['join'][0] >= \
+        build_scheduler.timings['slow'][1]
+    assert build_scheduler.timings['slow'][1] < 0.2 + 0.15
+    assert build_scheduler.critical_path() == ['slow', 'join']
+
+
+def test_scheduler_stops_on_failure():
+    ran = []
+
+    def _fail():
+        raise exceptions.PipInstallError('x')
+
+    stages = [
+        Stage('fail', _fail, outputs=['a']),
+        Stage('after', lambda: ran.append('after'), ['a'], ['b']),
+    ]
+    with pytest.raises(exceptions.PipInstallError):
+        Scheduler(stages).run()
+    assert not ran
+
+
+def test_scheduler_skip():
+    ran = []
+    stages = [
+        Stage('first', lambda: ran.append('first'), outputs=['a']),
+        Stage('second', lambda: ran.append('second'), ['a'], ['b']),
+    ]
+    Scheduler(stages).run(skip=['first'])
+    assert ran == ['second']
+
+    # skipped stages still wait for the stages they depend on
+    stages = [
+        Stage('first', lambda: time.sleep(0.2) or ran.append('first'),
+              outputs=['a']),
+        Stage('second', lambda: ran.append('second'), ['a'], ['b']),
+        Stage('third', lambda: ran.append('third'), ['b'], ['c']),
+    ]
+    del ran[:]
+    Scheduler(stages).run(skip=['second'])
+    assert ran == ['first', 'third']
+
+
+def test_scheduler_invalid_graph():
+    with pytest.raises(exceptions.AgentPackagerError, match='no stage'):
+        Scheduler([Stage('a', None, ['missing'], ['a'])])
+    with pytest.raises(exceptions.AgentPackagerError, match='more than one'):
+        Scheduler([Stage('a', None, outputs=['a']),
+                   Stage('b', None, outputs=['a'])])
+    with pytest.raises(exceptions.AgentPackagerError, match='itself'):
+        Scheduler([Stage('a', None, ['b'], ['a']),
+                   Stage('b', None, ['a'], ['b'])])
+
+
+def test_build_stages():
+    config = ap._import_config(CONFIG_FILE)
+    modules = ap._merge_modules(ap._set_defaults(), config)
+    build = ap.Build(config, modules, TEST_VENV, None, TARGET_PACKAGE, '.')
+    stages = dict((stage.name, stage) for stage in build.stages())
+    assert 'zip' not in stages
+    assert 'exclude' not in stages
+    assert 'publish' not in stages
+    assert stages['validate'].inputs == ['relocated']
+    assert stages['archive'].inputs == ['relocated']
+
+    config.set('output', 'zip_site_packages', 'true')
+    config.set('output', 'strip_debug_symbols', 'true')
+    modules['exclude_modules'].append('pytest')
+    build = ap.Build(config, modules, TEST_VENV, None, TARGET_PACKAGE, '.',
+                     no_validate=True, cache_entry=(None, 'key'))
+    stages = dict((stage.name, stage) for stage in build.stages())
+    assert 'validate' not in stages
+    assert stages['strip'].inputs == ['excluded']
+    assert stages['relocate'].inputs == ['stripped']
+    assert stages['archive'].inputs == ['zipped']
+    assert stages['publish'].inputs == ['archive']
+    Scheduler(stages.values())
+
+
+def test_streamed_package_logs_to_stderr(monkeypatch):
+    monkeypatch.setattr(utils, 'is_virtualenv', lambda venv: False)
+    config = ap._import_config(CONFIG_FILE)
+    # streaming to stdout may be configured rather than passed as `output`
+    config.set('output', 'tar', '-')
+    config.set('output', 'chunks', '2')
+    handler = logging.StreamHandler(sys.stdout)
+    logging.getLogger().addHandler(handler)
+    try:
+        with pytest.raises(exceptions.ConfigFileError, match='chunked'):
+            ap.create(config=config)
+        assert handler.stream is sys.stderr
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+
+def test_streamed_package_waits_for_validation(http_server, tmpdir):
+    config = ap._import_config(CONFIG_FILE)
+    modules = ap._merge_modules(ap._set_defaults(), config)
+    venv = tmpdir.join('env')
+    venv.join('content.file').write('CONTENT', ensure=True)
+    url = http_server.url + '/packages/agent.tar.gz'
+    build = ap.Build(config, modules, str(venv), None, url, str(tmpdir))
+    stages = [stage for stage in build.stages()
+              if stage.name in ('archive', 'validate')]
+    assert stages[0].inputs == ['relocated', 'validated']
+
+    def _validate():
+        raise exceptions.ImportCheckError('broken')
+    stages[1].func = _validate
+    with pytest.raises(exceptions.ImportCheckError):
+        Scheduler(stages, initial=['relocated']).run({'relocated': None})
+    assert not os.path.exists(os.path.join(http_server.root, 'packages'))
+
+    stages[1].func = lambda: None
+    Scheduler(stages, initial=['relocated']).run({'relocated': None})
+    utils.verify_tar(os.path.join(http_server.root, 'packages',
+                                  'agent.tar.gz'))
+
+
+def test_checkpoint(tmpdir):
+    path = str(tmpdir.join('cloudify', '.checkpoint.json'))
+    assert Checkpoint.load(path, 'key') is None
+    checkpoint = Checkpoint(path, 'key')
+    checkpoint.complete_stage('make_venv')
+    checkpoint.install('xmltodict')
+    loaded = Checkpoint.load(path, 'key')
+    assert loaded.stages == ['make_venv']
+    assert loaded.is_installed('xmltodict')
+    assert Checkpoint.load(path, 'other') is None
+    checkpoint.remove()
+    assert not os.path.exists(path)
+
+
+def test_resume(tmpdir, monkeypatch):
+    venv = tmpdir.join('env').ensure(dir=True)
+    monkeypatch.setattr(ap, 'CHECKPOINT_FILE', str(tmpdir.join('cp.json')))
+    assert ap._resume(str(venv), 'key') is None
+
+    checkpoint = Checkpoint(ap.CHECKPOINT_FILE, 'key')
+    checkpoint.complete_stage('make_venv')
+    checkpoint.install('xmltodict')
+    assert ap._resume(str(venv), 'key').is_installed('xmltodict')
+
+    installed = []
+    monkeypatch.setattr(utils, 'install_module',
+                        lambda module, venv: installed.append(module))
+    installer = ap.ModuleInstaller(None, str(venv), None,
+                                   sources={'six': '/tmp/six.tar.gz'},
+                                   checkpoint=checkpoint)
+    installer.install_modules(['xmltodict', 'six'])
+    assert installed == ['/tmp/six.tar.gz']
+    assert Checkpoint.load(ap.CHECKPOINT_FILE, 'key').installed == [
+        'xmltodict', 'six']
+
+    # a checkpoint of another config starts the build over
+    assert ap._resume(str(venv), 'other') is None
+    assert not venv.check()
+    assert not os.path.exists(ap.CHECKPOINT_FILE)
+
+
+def _make_wheel(directory, name, version, requires=()):
+    dist_info = '{0}-{1}.dist-info'.format(name, version)
+    path = str(directory.join('{0}-{1}-py2.py3-none-any.whl'.format(
+        name, version)))
+    with zipfile.ZipFile(path, 'w') as wheel:
+        wheel.writestr('{0}/__init__.py'.format(name), 'VALUE = 1\n')
+        wheel.writestr('{0}-{1}.data/scripts/{0}-run'.format(name, version),
+                       '#!python\nprint(1)\n')
+        wheel.writestr(dist_info + '/METADATA', '\n'.join(
+            ['Name: {0}'.format(name), 'Version: {0}'.format(version)] +
+            ['Requires-Dist: {0}'.format(r) for r in requires] + ['', '']))
+        wheel.writestr(dist_info + '/WHEEL', 'Root-Is-Purelib: true\n')
+        wheel.writestr(dist_info + '/entry_points.txt',
+                       '[console_scripts]\n{0} = {0}:main\n'.format(name))
+    return path
+
+
+def test_parse_wheel_name():
+    assert installers.parse_wheel_name('/w/Foo_Bar-1.0-py2.py3-none-any.whl') \
+        == ('foo-bar', '1.0', set(['py2-none-any', 'py3-none-any']))
+    with pytest.raises(ValueError):
+        installers.parse_wheel_name('foo-1.0.whl')
+
+
+def test_install_wheel(tmpdir):
+    wheel = _make_wheel(tmpdir, 'foo', '1.0', [
+        'bar>=1', 'baz; python_version < "3"', 'qux; extra == "x"'])
+    assert installers.get_requirements(
+        wheel, (), {'python_version': '3.8'}) == ['bar>=1']
+    assert installers.get_requirements(
+        wheel, ('x',), {'python_version': '2.7'}) == ['bar>=1', 'baz', 'qux']
+
+    lib, scripts = tmpdir.join('lib'), tmpdir.join('bin')
+    environment = {
+        'paths': {'purelib': str(lib), 'platlib': str(lib),
+                  'scripts': str(scripts), 'data': str(tmpdir)},
+        'executable': '/env/bin/python',
+        'markers': {'python_version': '3.8'},
+    }
+    installed = installers.install_wheel(wheel, environment)
+    assert installed == [str(lib.join('foo', '__init__.py'))]
+    assert scripts.join('foo-run').read().startswith('#!/env/bin/python\n')
+    assert 'from foo import main' in scripts.join('foo').read()
+    assert os.access(str(scripts.join('foo')), os.X_OK)
+    dist_info = lib.join('foo-1.0.dist-info')
+    assert dist_info.join('INSTALLER').read() == 'cfy-ap\n'
+    record = dist_info.join('RECORD').read().splitlines()
+    assert 'foo/__init__.py,{0},10'.format(
+        installers._record_hash(b'VALUE = 1\n')) in record
+    assert '../bin/foo-run' in [line.split(',')[0] for line in record]
+
+
+def test_resolve_wheels(tmpdir, monkeypatch):
+    wheelhouse = tmpdir.mkdir('wheelhouse')
+    foo = _make_wheel(wheelhouse, 'foo', '1.0', ['bar>=1', 'six'])
+    _make_wheel(wheelhouse, 'bar', '0.9')
+    bar = _make_wheel(wheelhouse, 'bar', '1.1')
+    enum34 = _make_wheel(wheelhouse, 'enum34', '1.1.10')
+    monkeypatch.setattr(utils, 'get_venv_environment', lambda venv: {
+        'tags': ['py3-none-any'], 'markers': {'python_version': '3.11'}})
+    monkeypatch.setattr(utils, 'get_distributions', lambda venv: [
+        {'name': 'six', 'version': '1.16.0'}])
+    installer = installers.WheelInstaller('env', str(wheelhouse))
+    assert installer.resolve(['foo', 'missing', 'six<1', '/tmp/a.tar.gz']) \
+        == ({'foo': foo, 'bar': bar}, ['missing'], ['six<1', '/tmp/a.tar.gz'])
+    # requirements of other environments are left out, even if a
+    # universal wheel satisfies them
+    assert installer.resolve([
+        'enum34; python_version < "3.4"', 'other; python_version < "3"']) \
+        == ({}, [], [])
+    assert installer.resolve(['enum34; python_version >= "3.4"']) == (
+        {'enum34': enum34}, [], [])
+    # a wheel mustn't replace the url a direct reference points at
+    assert installer.resolve(['foo @ https://example.com/foo-2.0.tar.gz']) \
+        == ({}, [], ['foo @ https://example.com/foo-2.0.tar.gz'])
+
+    with pytest.raises(exceptions.ConfigFileError):
+        installers.get_installer('easy_install', 'env')
+
+
+def test_wheel_installer_pip_fallback(tmpdir, monkeypatch):
+    # a fake pip which records its arguments, one per line
+    venv = tmpdir.mkdir('env')
+    pip = venv.mkdir('bin').join('pip')
+    pip.write('#!/bin/sh\nfor arg; do echo "$arg"; done >> {0}\n'.format(
+        tmpdir.join('args')))
+    pip.chmod(0o755)
+    # without tags, e.g. with old versions of pip, everything falls back
+    monkeypatch.setattr(utils, 'get_venv_environment', lambda venv: {
+        'tags': None, 'markers': {}})
+    installer = installers.WheelInstaller(str(venv))
+    requirement = 'requests>=2.9.1,<3.0.0'
+    with tmpdir.as_cwd():
+        installer.install_modules([requirement, 'six'])
+        assert tmpdir.join('args').read().splitlines() == [
+            'install', requirement, 'six']
+        assert not tmpdir.join('=2.9.1,').check()
+
+        tmpdir.join('args').remove()
+        requirements = tmpdir.join('requirements.txt')
+        requirements.write(requirement + '\n')
+        installer.install_requirements_file(str(requirements))
+        assert tmpdir.join('args').read().splitlines() == [
+            'install', '-r{0}'.format(requirements)]
+
+
+def test_fetch_sources(http_server, tmpdir):
+    _write_sources(http_server.root)
+    modules = {
+        'additional_plugins': {
+            'plugin': http_server.url + '/agent.tar.gz?x=1',
+            'other': 'xmltodict',
+        },
+        'agent': http_server.url + '/agent.tar.gz',
+    }
+    sources = ap._fetch_sources(modules, str(tmpdir))
+    assert sorted(sources) == [
+        http_server.url + '/agent.tar.gz',
+        http_server.url + '/agent.tar.gz?x=1']
+    for path in sources.values():
+        assert os.path.basename(path) == 'agent.tar.gz'
+        with open(path, 'rb') as f:
+            assert f.read() == b'AGENT'
+
+
 def test_create_agent_package():
     args = FakeArgs()
     args.force = True
@@ -181,7 +1390,7 @@ def test_create_agent_package():
     os.makedirs(TEST_VENV)
     utils.run('tar -xzvf {0} -C {1} --strip-components=1'.format(
         config.get('output', 'tar'), BASE_DIR))
-    os.remove(config.get('output', 'tar'))
+    _remove_archive(config.get('output', 'tar'))
     assert os.path.isdir(TEST_VENV)
     pip_freeze_output = utils.get_installed(TEST_VENV).lower()
     for required_module in required_modules:
@@ -197,7 +1406,7 @@ def test_create_agent_package_in_existing_venv_force():
         cli._run(args)
     finally:
         shutil.rmtree(TEST_VENV)
-        os.remove(TARGET_PACKAGE)
+        _remove_archive(TARGET_PACKAGE)
 
 
 def test_create_agent_package_in_existing_venv_no_force(venv):
@@ -260,7 +1469,7 @@ def test_create_agent_package_with_version_info(venv):
         ap.create(config, force=True, verbose=True)
         assert os.path.isfile(archive)
     finally:
-        os.remove(archive)
+        _remove_archive(archive)
         os.environ.pop('VERSION')
         os.environ.pop('PRERELEASE')
         os.environ.pop('BUILD')
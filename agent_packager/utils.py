@@ -1,14 +1,32 @@
+import errno
 import logging
 import subprocess
 import requests
+import hashlib
+import heapq
+import json
 import re
 import os
+import stat
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import distutils
+from multiprocessing.pool import ThreadPool
 
 from . import exceptions
 
+try:
+    from shlex import quote
+except ImportError:
+    # py2
+    from pipes import quote
+
+
+UPLOAD_RETRIES = 3
+UPLOAD_TIMEOUT = 60
 
 lgr = logging.getLogger()
 
@@ -31,6 +49,20 @@ def run(cmd, no_print=False):
     return p
 
 
+def get_interpreter_id(python=None):
+    """returns a string identifying a python interpreter's version,
+    architecture and libc
+    """
+    python = python or sys.executable
+    p = run('{0} -c "import platform, sys; '
+            'print((sys.version, platform.machine(), platform.libc_ver()))"'
+            .format(python), no_print=True)
+    if not p.returncode == 0:
+        raise exceptions.AgentPackagerError(
+            'Could not run python: {0}'.format(python))
+    return p.stdout.strip()
+
+
 def make_virtualenv(virtualenv_dir, python=None):
     """creates a virtualenv
 
@@ -102,6 +134,22 @@ def install_requirements_file(path, venv):
         raise exceptions.PipInstallError(path)
 
 
+def build_wheels(modules, wheelhouse, venv):
+    """builds or downloads wheels of modules and their requirements into a
+    directory, using the wheels already in it where possible
+
+    :param list modules: requirements to build wheels of.
+    :param string wheelhouse: the directory to add the wheels to.
+    :param string venv: path of the virtualenv whose pip to use.
+    :return: whether all wheels were built
+    """
+    lgr.debug('Building wheels of {0} in {1}'.format(modules, wheelhouse))
+    p = run('{0}/bin/pip wheel --wheel-dir {1} --find-links {1} {2}'.format(
+        venv, quote(wheelhouse),
+        ' '.join(quote(module) for module in modules)))
+    return p.returncode == 0
+
+
 def uninstall_module(module, venv):
     """uninstalls a module from a virtualenv
 
@@ -115,6 +163,43 @@ def uninstall_module(module, venv):
         raise exceptions.PipUninstallError(module)
 
 
+def install_modules(modules, venv):
+    """installs several modules in a virtualenv using a single pip call
+
+    Unlike `install_module`, every module is quoted, so requirements with
+    specifiers (e.g. `requests>=2.9.1,<3.0.0`) are passed to pip as is.
+    :param list modules: modules to install. can be urls or paths.
+    :param string venv: path of virtualenv to install in.
+    """
+    lgr.debug('Installing {0} in venv {1}'.format(modules, venv))
+    pip_cmd = '{1}/bin/pip install {0}'.format(
+        ' '.join(quote(module) for module in modules), venv)
+    p = run(pip_cmd)
+    if not p.returncode == 0:
+        raise exceptions.PipInstallError(', '.join(modules))
+
+
+def uninstall_modules(modules, venv):
+    """uninstalls several modules from a virtualenv using a single pip call
+
+    :param list modules: names of modules to uninstall.
+    :param string venv: path of virtualenv to uninstall from.
+    """
+    lgr.debug('Uninstalling {0} in venv {1}'.format(modules, venv))
+    pip_cmd = '{1}/bin/pip uninstall -y {0}'.format(
+        ' '.join(quote(module) for module in modules), venv)
+    p = run(pip_cmd)
+    if not p.returncode == 0:
+        raise exceptions.PipUninstallError(', '.join(modules))
+
+
+def get_distributions(venv):
+    """returns the name, version, requirements and installed size of every
+    distribution installed in a virtualenv
+    """
+    return run_venv_helper(venv, 'distributions')
+
+
 def get_installed(venv):
     p = run('{0}/bin/pip freeze'.format(venv), no_print=True)
     return p.stdout
@@ -134,6 +219,144 @@ def check_installed(module, venv):
     return False
 
 
+def run_venv_helper(venv, command, *args):
+    """runs a `venv_helper` command using the virtualenv's interpreter
+
+    :param string venv: path of the virtualenv.
+    :param string command: name of the helper command to run.
+    :return: the command's JSON result
+    """
+    helper = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'venv_helper.py')
+    p = run('{0} {1} {2} {3}'.format(
+        os.path.join(venv, 'bin', 'python'), quote(helper),
+        command, ' '.join(quote(arg) for arg in args)), no_print=True)
+    if not p.returncode == 0:
+        raise exceptions.AgentPackagerError(
+            'Failed running {0} in {1}: {2}'.format(command, venv, p.strerr))
+    return json.loads(p.stdout)
+
+
+def compile_files(paths, venv):
+    """compiles python files using the virtualenv's interpreter
+
+    As when pip installs modules, files which can't be compiled (e.g.
+    python 2 only modules of a python 3 package) are ignored.
+    """
+    if not paths:
+        return
+    fd, file_list = tempfile.mkstemp(suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+        p = run('{0} -m compileall -q -i {1}'.format(
+            os.path.join(venv, 'bin', 'python'), quote(file_list)),
+            no_print=True)
+        if not p.returncode == 0:
+            lgr.debug('Some files could not be compiled: {0}'.format(
+                p.stdout))
+    finally:
+        os.remove(file_list)
+
+
+def get_venv_environment(venv):
+    """returns the wheel tags, environment markers and installation paths
+    of a virtualenv, see `venv_helper.get_environment`
+    """
+    return run_venv_helper(venv, 'environment')
+
+
+def check_imports(modules, venv):
+    """imports the top level modules of the given distributions
+
+    All of the imports are done by a single interpreter of the virtualenv.
+
+    :param list modules: names of distributions to check.
+    :param string venv: path of the virtualenv.
+    :return: dict mapping each distribution to its import results
+    """
+    lgr.debug('Importing {0} in venv {1}'.format(modules, venv))
+    return run_venv_helper(venv, 'imports', *modules)
+
+
+def zip_site_packages(venv, zip_name):
+    """moves the pure python distributions of a virtualenv's
+    site-packages into a zip file
+
+    :param string venv: path of the virtualenv.
+    :param string zip_name: name of the zip file to create
+     within site-packages.
+    :return: dict describing the zipped and kept distributions
+    """
+    lgr.debug('Zipping site-packages of venv {0}'.format(venv))
+    return run_venv_helper(venv, 'zip', zip_name)
+
+
+ELF_MAGIC = b'\x7fELF'
+
+
+def is_elf(path):
+    """returns whether a file is an ELF binary
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(ELF_MAGIC)) == ELF_MAGIC
+
+
+def find_shared_objects(path):
+    """returns the paths of all ELF shared objects under a directory,
+    not following symlinks
+    """
+    shared_objects = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            if not (name.endswith('.so') or '.so.' in name):
+                continue
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path) and is_elf(file_path):
+                shared_objects.append(file_path)
+    return sorted(shared_objects)
+
+
+def strip_debug_symbols(path, debug_file=None):
+    """strips the debug sections of an ELF file
+
+    The file is stripped into a temporary copy which then replaces it, so
+    that the file is either fully stripped or left as it was. Files without
+    debug sections are left as they are.
+
+    :param string path: path of the file to strip.
+    :param string debug_file: if given, the debug sections are kept in
+     this file, which the stripped file is linked to (see gdb's
+     `.gnu_debuglink`).
+    :return: the number of bytes saved
+    """
+    tmp = '{0}.stripped'.format(path)
+    try:
+        p = run('strip --strip-debug -o {0} {1}'.format(
+            quote(tmp), quote(path)), no_print=True)
+        if not p.returncode == 0:
+            raise exceptions.StripError('{0}: {1}'.format(path, p.strerr))
+        saved = os.path.getsize(path) - os.path.getsize(tmp)
+        if saved <= 0:
+            return 0
+        if debug_file:
+            for command in ('objcopy --only-keep-debug {0} {1}',
+                            'objcopy --add-gnu-debuglink={1} {2}'):
+                p = run(command.format(
+                    quote(path), quote(debug_file), quote(tmp)),
+                    no_print=True)
+                if not p.returncode == 0:
+                    raise exceptions.StripError(
+                        '{0}: {1}'.format(path, p.strerr))
+            saved = os.path.getsize(path) - os.path.getsize(tmp)
+        os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        os.rename(tmp, path)
+        return saved
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 def download_file(url, destination):
     """downloads a file to a destination
     """
@@ -149,11 +372,418 @@ def download_file(url, destination):
                 f.flush()
 
 
-def tar(source, destination):
+class HashingFile(object):
+    """Wraps a file object, hashing every chunk that passes through it.
+
+    Used to compute digests while streaming, so that archives don't have to
+    be re-read from disk only to be checksummed.
+    """
+    def __init__(self, fileobj, name=None):
+        self._fileobj = fileobj
+        self.name = name or getattr(fileobj, 'name', '')
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _add_to_tar(tar, path, files, recursive=True, arcname=None):
+    info = tar.gettarinfo(path, arcname)
+    if info is None:
+        # sockets and other unsupported file types
+        lgr.debug('Skipping unsupported file: {0}'.format(path))
+        return
+    if info.isreg():
+        with open(path, 'rb') as f:
+            hashing = HashingFile(f)
+            tar.addfile(info, hashing)
+        files[info.name] = hashing.hexdigest()
+    else:
+        tar.addfile(info)
+    if info.isdir() and recursive:
+        for name in sorted(os.listdir(path)):
+            _add_to_tar(tar, os.path.join(path, name), files,
+                        arcname=os.path.join(arcname or path, name))
+
+
+def write_tar(source, fileobj, arcname=None, name=None):
+    """writes a tar.gz of source to a file object, which only has to
+    support writing, e.g. a pipe
+
+    The archive's sha256 and the sha256 of every regular file added to it
+    are computed while the archive is being written.
+
+    :param string source: path to the directory to archive
+    :param fileobj: the file object to write to
+    :param string arcname: name of source within the archive,
+     defaults to source.
+    :param string name: the name of the archive, stored in its header
+    :return: a tuple of the archive's sha256 and a dict mapping
+     each archived file's name to its sha256
+    """
+    files = {}
+    hashing = HashingFile(fileobj, name)
+    tar = tarfile.open(name, 'w:gz', fileobj=hashing)
+    try:
+        _add_to_tar(tar, source, files, arcname=arcname)
+    finally:
+        tar.close()
+    return hashing.hexdigest(), files
+
+
+def tar(source, destination, arcname=None):
+    """creates a tar.gz file from source, see `write_tar`
+
+    :param string source: path to the directory to archive
+    :param string destination: path of the tar.gz file to create
+    :param string arcname: name of source within the archive,
+     defaults to source.
+    :return: a tuple of the archive's sha256 and a dict mapping
+     each archived file's name to its sha256
+    """
     lgr.info('Creating tar file: {0}'.format(destination))
-    tar = tarfile.open(destination, "w:gz")
-    tar.add(source)
-    tar.close()
+    with open(destination, 'wb') as f:
+        return write_tar(source, f, arcname, name=destination)
+
+
+def _stream_tar(source, url, arcname=None, timeout=UPLOAD_TIMEOUT):
+    """uploads a tar.gz of source using a single chunked PUT request,
+    writing the archive in a thread while it is being sent
+
+    :return: the response, and the result of `write_tar`
+    """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    writer = os.fdopen(write_fd, 'wb')
+    result = {}
+
+    def _write():
+        try:
+            result['tar'] = write_tar(source, writer, arcname,
+                                      name=url.rstrip('/').split('/')[-1])
+        except Exception as e:
+            result['error'] = e
+        finally:
+            try:
+                writer.close()
+            except (IOError, OSError):
+                pass
+
+    def _body():
+        for chunk in iter(lambda: reader.read(65536), b''):
+            yield chunk
+        thread.join()
+        if 'error' in result:
+            # abort the request, rather than upload a partial archive
+            raise result['error']
+
+    thread = threading.Thread(target=_write)
+    thread.daemon = True
+    thread.start()
+    response = None
+    try:
+        response = requests.put(url, data=_body(), timeout=timeout)
+    except Exception as e:
+        error = e
+    else:
+        error = None
+    finally:
+        # if the upload failed, this stops the writer
+        reader.close()
+        thread.join()
+    tar_error = result.get('error')
+    if tar_error and not getattr(tar_error, 'errno', None) == errno.EPIPE:
+        raise exceptions.TarCreateError(tar_error)
+    if error:
+        raise error
+    return response, result['tar']
+
+
+def upload_tar(source, url, arcname=None, retries=UPLOAD_RETRIES,
+               timeout=UPLOAD_TIMEOUT):
+    """streams a tar.gz of source to a url using HTTP PUT, without
+    writing it to disk
+
+    Uploads failing due to connection errors or server errors are
+    retried, by archiving source again.
+    :param string source: path to the directory to archive
+    :param string url: url to upload the archive to
+    :param string arcname: name of source within the archive,
+     defaults to source.
+    :param int retries: the number of times to try uploading.
+    :return: a tuple of the archive's sha256 and a dict mapping
+     each archived file's name to its sha256
+    """
+    lgr.info('Uploading tar file to {0}'.format(url))
+    for attempt in range(1, retries + 1):
+        try:
+            response, result = _stream_tar(source, url, arcname, timeout)
+        except requests.RequestException as e:
+            error = str(e)
+        else:
+            if response.status_code < 400:
+                return result
+            error = 'HTTP {0}'.format(response.status_code)
+            if response.status_code < 500:
+                break
+        if attempt < retries:
+            lgr.warning('Uploading to {0} failed ({1}), retrying...'.format(
+                url, error))
+            time.sleep(attempt)
+    raise exceptions.UploadError('{0}: {1}'.format(url, error))
+
+
+def _collect_tar_entries(path, arcname, entries):
+    """collects the paths, archive names and stats of all entries under
+    a path, in the order in which they'd be added to a tar file
+    """
+    entries.append((path, arcname, os.lstat(path)))
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            _collect_tar_entries(os.path.join(path, name),
+                                 os.path.join(arcname, name), entries)
+    return entries
+
+
+def get_chunk_paths(destination, count):
+    """returns the paths of the index and the chunks of a chunked archive
+
+    :param string destination: path of the archive, had it been a single
+     tar.gz file.
+    :param int count: number of chunks.
+    """
+    base = destination
+    if base.endswith('.tar.gz'):
+        base = base[:-len('.tar.gz')]
+    chunks = ['{0}.part{1:03d}.tar.gz'.format(base, i) for i in range(count)]
+    return '{0}.index.json'.format(base), chunks
+
+
+def _write_chunk(destination, paths):
+    files = {}
+    with open(destination, 'wb') as f:
+        hashing = HashingFile(f)
+        tar = tarfile.open(destination, 'w:gz', fileobj=hashing)
+        try:
+            for path, arcname in paths:
+                _add_to_tar(tar, path, files, recursive=False,
+                            arcname=arcname)
+        finally:
+            tar.close()
+    return hashing.hexdigest(), files
+
+
+def tar_chunks(source, destination, count, arcname=None):
+    """creates a tar.gz file per chunk of source, and an index file
+
+    Regular files are distributed between the chunks so that the chunks
+    hold roughly the same number of bytes; all other entries, such as
+    directories and symlinks, are put in the first chunk. Every chunk is
+    independent, so chunks can be downloaded and extracted concurrently
+    (see `agent_packager.extractor`). The chunks are compressed in
+    parallel.
+    :param string source: path to the directory to archive
+    :param string destination: path of the archive, had it been a single
+     tar.gz file. The chunks and index are named after it.
+    :param int count: number of chunks to create.
+    :param string arcname: name of source within the archive,
+     defaults to source.
+    :return: the path of the index file
+    """
+    index_path, chunk_paths = get_chunk_paths(destination, count)
+    lgr.info('Creating {0} tar files: {1}'.format(count, index_path))
+    entries = _collect_tar_entries(source, arcname or source, [])
+
+    chunks = [[] for _ in range(count)]
+    sizes = [(0, i) for i in range(count)]
+    regular = []
+    for path, name, lstat in entries:
+        if stat.S_ISREG(lstat.st_mode):
+            regular.append((lstat.st_size, path, name))
+        else:
+            chunks[0].append((path, name))
+    # place the largest files first, each in the currently smallest chunk
+    for size, path, name in sorted(regular, reverse=True):
+        total, i = heapq.heappop(sizes)
+        chunks[i].append((path, name))
+        heapq.heappush(sizes, (total + size, i))
+    chunk_bytes = dict((i, total) for total, i in sizes)
+
+    pool = ThreadPool(count)
+    try:
+        results = pool.map(
+            lambda i: _write_chunk(chunk_paths[i], sorted(chunks[i])),
+            range(count))
+    finally:
+        pool.close()
+        pool.join()
+
+    index = {'chunks': [], 'files': {}}
+    for i, (digest, files) in enumerate(results):
+        index['chunks'].append({
+            'name': os.path.basename(chunk_paths[i]),
+            'sha256': digest,
+            'size': os.path.getsize(chunk_paths[i]),
+            'bytes': chunk_bytes[i],
+            'entries': len(chunks[i]),
+        })
+        index['files'].update(files)
+    with open(index_path, 'w') as f:
+        json.dump(index, f, sort_keys=True, indent=4, separators=(',', ': '))
+    return index_path
+
+
+def get_sidecar_paths(archive):
+    """returns the paths of the checksum and manifest files of an archive
+    """
+    return archive + '.sha256', archive + '.manifest.json'
+
+
+def write_sidecars(archive, digest, files):
+    """writes the checksum and manifest files next to an archive
+
+    The checksum file is in the format used by `sha256sum`, so it can also
+    be checked using `sha256sum -c`.
+
+    :param string archive: path to the archive
+    :param string digest: sha256 of the archive
+    :param dict files: mapping of archived file names to their sha256
+    """
+    checksum_file, manifest_file = get_sidecar_paths(archive)
+    lgr.debug('Writing {0} and {1}'.format(checksum_file, manifest_file))
+    checksum, manifest = _get_sidecars(archive, digest, files)
+    with open(checksum_file, 'w') as f:
+        f.write(checksum)
+    with open(manifest_file, 'w') as f:
+        f.write(manifest)
+    return checksum_file, manifest_file
+
+
+def _get_sidecars(archive, digest, files):
+    name = archive.rstrip('/').split('/')[-1]
+    checksum = '{0}  {1}\n'.format(digest, name)
+    manifest = json.dumps({
+        'archive': name,
+        'sha256': digest,
+        'files': files,
+    }, sort_keys=True, indent=4, separators=(',', ': '))
+    return checksum, manifest
+
+
+def upload_sidecars(url, digest, files, timeout=UPLOAD_TIMEOUT):
+    """uploads the checksum and manifest files of an archive uploaded to
+    a url, next to it (see `write_sidecars`)
+    """
+    for sidecar_url, content in zip(get_sidecar_paths(url),
+                                    _get_sidecars(url, digest, files)):
+        lgr.debug('Uploading {0}'.format(sidecar_url))
+        response = requests.put(sidecar_url, data=content.encode('utf-8'),
+                                timeout=timeout)
+        if response.status_code >= 400:
+            raise exceptions.UploadError('{0}: HTTP {1}'.format(
+                sidecar_url, response.status_code))
+
+
+def read_manifest(archive):
+    """returns the sha256 and the file checksums of an archive,
+    as listed in its manifest file
+    """
+    _, manifest_file = get_sidecar_paths(archive)
+    if not os.path.isfile(manifest_file):
+        raise exceptions.ArchiveVerificationError(
+            'No such file: {0}'.format(manifest_file))
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    return manifest['sha256'], manifest['files']
+
+
+def verify_tar(archive):
+    """verifies an archive against its manifest file
+
+    Both the archive's digest and the digest of each of the files contained
+    in it are checked in a single streaming read of the archive.
+
+    :param string archive: path to the archive
+    """
+    lgr.info('Verifying {0}'.format(archive))
+    expected_digest, expected = read_manifest(archive)
+    errors = []
+    seen = set()
+    with open(archive, 'rb') as f:
+        hashing = HashingFile(f)
+        with tarfile.open(fileobj=hashing, mode='r|gz') as tar:
+            for member in tar:
+                if not member.isreg():
+                    continue
+                seen.add(member.name)
+                digest = hashlib.sha256()
+                member_file = tar.extractfile(member)
+                for chunk in iter(lambda: member_file.read(65536), b''):
+                    digest.update(chunk)
+                if member.name not in expected:
+                    errors.append('{0}: not in manifest'.format(member.name))
+                elif digest.hexdigest() != expected[member.name]:
+                    errors.append('{0}: checksum mismatch'.format(
+                        member.name))
+        # consume the end-of-archive padding so that the archive's
+        # digest covers the whole file
+        while hashing.read(65536):
+            pass
+    for name in sorted(set(expected) - seen):
+        errors.append('{0}: missing from archive'.format(name))
+    if hashing.hexdigest() != expected_digest:
+        errors.append('{0}: checksum mismatch'.format(
+            os.path.basename(archive)))
+    if errors:
+        raise exceptions.ArchiveVerificationError(
+            '{0}: {1}'.format(archive, ', '.join(errors)))
+    lgr.info('{0} verified successfully'.format(archive))
+
+
+def get_size(path):
+    """returns the total size of the regular files under a directory,
+    in bytes, not following symlinks
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_stat = os.lstat(os.path.join(root, name))
+            if stat.S_ISREG(file_stat.st_mode):
+                size += file_stat.st_size
+    return size
+
+
+def get_available_memory(path):
+    """returns the number of bytes which can be written to a memory
+    backed filesystem (e.g. /dev/shm)
+
+    As files on such filesystems take up memory, this is the lower of the
+    space left on the filesystem and the memory available on the host.
+    """
+    vfs = os.statvfs(path)
+    available = vfs.f_bavail * vfs.f_frsize
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # the value is in kB
+                    available = min(available, int(line.split()[1]) * 1024)
+                    break
+    except IOError:
+        pass
+    return available
 
 
 def get_env_bin_path(env_path):
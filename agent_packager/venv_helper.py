@@ -0,0 +1,360 @@
+"""Helpers that run inside the packaged virtualenv.
+
+This module is executed by the virtualenv's own interpreter (which may be
+a different python version than the one running the packager), so it must
+only use the standard library and stay compatible with python 2.7.
+
+Usage: python venv_helper.py COMMAND [ARGS...]
+Results are printed to stdout as JSON.
+"""
+import csv
+import glob
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import sysconfig
+import time
+import zipfile
+
+try:
+    from importlib import metadata
+except ImportError:
+    metadata = None
+
+
+def _name_variants(name):
+    return [name, name.replace('-', '_'), name.replace('_', '-')]
+
+
+def _top_level_from_files(files):
+    top_level = set()
+    for path in files:
+        parts = path.replace('\\', '/').split('/')
+        if parts[0] in ('..', '') or parts[0].endswith(
+                ('.dist-info', '.egg-info', '.data')):
+            continue
+        if len(parts) > 1 and parts[1] == '__init__.py':
+            top_level.add(parts[0])
+        elif len(parts) == 1 and parts[0].endswith('.py'):
+            top_level.add(parts[0][:-3])
+        elif len(parts) == 1 and parts[0].endswith(('.so', '.pyd')):
+            # native extensions, e.g. foo.cpython-311-x86_64-linux-gnu.so
+            top_level.add(parts[0].split('.')[0])
+    return sorted(top_level)
+
+
+def get_top_level(name):
+    """returns the top level modules of an installed distribution,
+    or None if the distribution isn't installed.
+
+    Distributions without a top_level.txt file are looked up in the list
+    of files they installed.
+    """
+    if metadata is not None:
+        for variant in _name_variants(name):
+            try:
+                dist = metadata.distribution(variant)
+            except metadata.PackageNotFoundError:
+                continue
+            top_level = dist.read_text('top_level.txt')
+            if top_level:
+                return sorted(set(top_level.split()))
+            return _top_level_from_files(str(f) for f in dist.files or [])
+        return None
+
+    import pkg_resources
+    for variant in _name_variants(name):
+        try:
+            dist = pkg_resources.get_distribution(variant)
+        except pkg_resources.DistributionNotFound:
+            continue
+        if dist.has_metadata('top_level.txt'):
+            return sorted(set(dist.get_metadata('top_level.txt').split()))
+        info_dir = getattr(dist, 'egg_info', None)
+        if not info_dir or not dist.location:
+            return []
+        return _top_level_from_files(_read_record(
+            dist.location, os.path.relpath(info_dir, dist.location)) or [])
+    return None
+
+
+def check_imports(names):
+    """imports every top level module of every given distribution
+
+    A failing import doesn't prevent the others from being checked.
+    Note that modules shared between distributions are only imported
+    (and timed) once.
+    """
+    # keep the virtualenv as it is, as it may be archived meanwhile
+    sys.dont_write_bytecode = True
+    results = {}
+    for name in names:
+        result = {'error': None, 'modules': {}, 'time': 0.0}
+        results[name] = result
+        top_level = get_top_level(name)
+        if top_level is None:
+            result['error'] = 'distribution not found'
+            continue
+        if not top_level:
+            result['error'] = 'no top level modules found'
+            continue
+        for module in top_level:
+            start = time.time()
+            try:
+                __import__(module)
+            except KeyboardInterrupt:
+                raise
+            except BaseException as e:
+                error = '{0}: {1}'.format(type(e).__name__, e)
+            else:
+                error = None
+            duration = time.time() - start
+            result['modules'][module] = {'error': error, 'time': duration}
+            result['time'] += duration
+    return results
+
+
+NATIVE_SUFFIXES = ('.so', '.pyd', '.dylib')
+# files that may be found within packages which don't need to be on disk
+NON_DATA_SUFFIXES = ('.py', '.pyc', '.pyo', '.pyi', 'py.typed')
+# these are never zipped, as they are used to manage the virtualenv
+NEVER_ZIPPED = ('pip', 'setuptools', 'wheel', 'distribute')
+# modules referring to these are assumed to need their files on disk
+NOT_ZIP_SAFE = re.compile(r'\b(__file__|__path__)\b')
+
+
+def get_site_packages():
+    return sysconfig.get_paths()['purelib']
+
+
+def _read_record(site_packages, info_dir):
+    """returns the files of a distribution, relative to site-packages,
+    or None if they are unknown
+    """
+    info_path = os.path.join(site_packages, info_dir)
+    record = os.path.join(info_path, 'RECORD')
+    if os.path.isfile(record):
+        with open(record) as f:
+            return [row[0] for row in csv.reader(f) if row]
+    installed_files = os.path.join(info_path, 'installed-files.txt')
+    if os.path.isfile(installed_files):
+        with open(installed_files) as f:
+            return [os.path.normpath(os.path.join(info_dir, line.strip()))
+                    for line in f if line.strip()]
+    return None
+
+
+def get_distributions(site_packages):
+    """returns a dict mapping each distribution's info directory to the
+    files it installed, relative to site-packages
+    """
+    distributions = {}
+    for name in sorted(os.listdir(site_packages)):
+        if name.endswith(('.dist-info', '.egg-info')) and \
+                os.path.isdir(os.path.join(site_packages, name)):
+            distributions[name] = _read_record(site_packages, name)
+    return distributions
+
+
+def _module_files(files):
+    """yields the path parts of the files of a distribution which are part
+    of its modules, i.e. not metadata, scripts or compiled files
+    """
+    for path in files:
+        parts = path.replace('\\', '/').split('/')
+        if parts[0] in ('..', '__pycache__') or parts[0].endswith(
+                ('.dist-info', '.egg-info', '.data')):
+            continue
+        if '__pycache__' in parts:
+            continue
+        yield parts
+
+
+def _zip_blocker(site_packages, files, owners):
+    """returns the reason a distribution can't be zipped, or None
+    """
+    if files is None:
+        return 'unknown files'
+    top_level = set()
+    for parts in _module_files(files):
+        path = '/'.join(parts)
+        top_level.add(parts[0])
+        if len(parts) == 1 and not parts[0].endswith('.py'):
+            return 'top level file {0}'.format(parts[0])
+        if parts[-1].endswith(NATIVE_SUFFIXES) or '.so.' in parts[-1]:
+            return 'native extension {0}'.format(path)
+        if not parts[-1].endswith(NON_DATA_SUFFIXES):
+            return 'data file {0}'.format(path)
+        if parts[-1].endswith('.py'):
+            if len(parts) > 1 and not os.path.isfile(os.path.join(
+                    site_packages, *parts[:-1] + ['__init__.py'])):
+                return 'namespace package {0}'.format('/'.join(parts[:-1]))
+            with io.open(os.path.join(site_packages, *parts),
+                         encoding='utf-8', errors='replace') as f:
+                if NOT_ZIP_SAFE.search(f.read()):
+                    return '{0} refers to its location'.format(path)
+    for name in top_level:
+        if len(owners.get(name, ())) > 1:
+            return '{0} is shared with another distribution'.format(name)
+    if not top_level:
+        return 'no modules'
+    return None
+
+
+def zip_site_packages(args):
+    """moves pure python distributions from site-packages into a zip file
+
+    The modules are stored compiled, and the zip file is added to sys.path
+    using a .pth file. Distributions with native extensions, data files,
+    or code referring to its own location are left as they are. The
+    distributions' metadata is kept in place, so they are still listed as
+    installed, but they can't be uninstalled by pip.
+    :param list args: the name of the zip file to create.
+    """
+    zip_name = args[0]
+    site_packages = get_site_packages()
+    distributions = get_distributions(site_packages)
+
+    owners = {}
+    for info_dir, files in distributions.items():
+        for parts in _module_files(files or []):
+            owners.setdefault(parts[0], set()).add(info_dir)
+
+    result = {'zip': os.path.join(site_packages, zip_name),
+              'zipped': [], 'kept': {}, 'modules': [], 'files_removed': 0}
+    zipped_modules = set()
+    for info_dir, files in sorted(distributions.items()):
+        name = re.split(r'-\d', info_dir)[0]
+        if name.lower().replace('_', '-') in NEVER_ZIPPED:
+            reason = 'used to manage the virtualenv'
+        else:
+            reason = _zip_blocker(site_packages, files, owners)
+        if reason:
+            result['kept'][info_dir] = reason
+            continue
+        result['zipped'].append(info_dir)
+        zipped_modules.update(parts[0] for parts in _module_files(files))
+
+    if not zipped_modules:
+        return result
+    zip_path = result['zip']
+    with zipfile.PyZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in sorted(zipped_modules):
+            zf.writepy(os.path.join(site_packages, name))
+    for name in sorted(zipped_modules):
+        path = os.path.join(site_packages, name)
+        if os.path.isdir(path):
+            for _, _, files in os.walk(path):
+                result['files_removed'] += len(files)
+            shutil.rmtree(path)
+        else:
+            name = name[:-3]
+            compiled = glob.glob(os.path.join(
+                site_packages, '__pycache__', name + '.*.pyc'))
+            for path_to_remove in [path] + compiled:
+                result['files_removed'] += 1
+                os.remove(path_to_remove)
+        result['modules'].append(name)
+    with open(os.path.join(site_packages, zip_name + '.pth'), 'w') as f:
+        f.write(zip_name + '\n')
+    return result
+
+
+def _requirement_name(requirement):
+    """returns the name of a requirement, or None if it's only required
+    by an extra
+    """
+    if ';' in requirement and 'extra' in requirement.split(';', 1)[1]:
+        return None
+    match = re.match(r'[A-Za-z0-9._-]+', requirement.strip())
+    return match.group(0) if match else None
+
+
+def _size(paths):
+    return sum(os.path.getsize(path) for path in paths
+               if os.path.isfile(path))
+
+
+def list_distributions(args):
+    """returns the name, version, requirements and installed size of every
+    installed distribution
+    """
+    result = []
+    if metadata is not None:
+        for dist in metadata.distributions():
+            result.append({
+                'name': dist.metadata['Name'],
+                'version': dist.version,
+                'requires': [name for name in (
+                    _requirement_name(r) for r in dist.requires or [])
+                    if name],
+                'size': _size(str(f.locate()) for f in dist.files or []),
+            })
+        return result
+
+    import pkg_resources
+    site_packages = get_site_packages()
+    for dist in pkg_resources.working_set:
+        files = _read_record(
+            site_packages, os.path.basename(dist.egg_info or '')) or []
+        result.append({
+            'name': dist.project_name,
+            'version': dist.version,
+            'requires': [r.project_name for r in dist.requires()],
+            'size': _size(os.path.join(site_packages, f) for f in files),
+        })
+    return result
+
+
+def get_environment(args):
+    """returns what installing wheels requires: the wheel tags the
+    interpreter supports, the environment markers are evaluated in, the
+    installation paths and the interpreter's path
+
+    The tags and markers are taken from the packaging library vendored by
+    pip, and are None if it isn't available.
+    """
+    result = {
+        'tags': None,
+        'markers': None,
+        'paths': sysconfig.get_paths(),
+        'executable': sys.executable,
+    }
+    try:
+        from pip._vendor.packaging import markers, tags
+    except ImportError:
+        return result
+    result['tags'] = [str(tag) for tag in tags.sys_tags()]
+    result['markers'] = markers.default_environment()
+    return result
+
+
+COMMANDS = {
+    'distributions': list_distributions,
+    'environment': get_environment,
+    'imports': check_imports,
+    'zip': zip_site_packages,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command, args = argv[0], argv[1:]
+    # the packager's own modules must not shadow those of the virtualenv
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path = [p for p in sys.path if os.path.abspath(p or '.') != here]
+    # keep imported modules from printing over our output
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = COMMANDS[command](args)
+    finally:
+        sys.stdout = stdout
+    json.dump(result, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
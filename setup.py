@@ -35,6 +35,7 @@ setup(
     entry_points={
         'console_scripts': [
             'cfy-ap = agent_packager.cli:main',
+            'cfy-ap-extract = agent_packager.extractor:main',
         ]
     },
     install_requires=install_requires,